@@ -0,0 +1,104 @@
+"""bench_create_user.py - Measures create user latency with serial and overlapped hashing"""
+# Usage (from the project root):
+#   python3 server/bench/bench_create_user.py --recaptcha-ms 120 --requests 200
+#   python3 server/bench/bench_create_user.py --connect-string sqlite:////tmp/bench.db \
+#       --executor thread --workers 4
+#
+# Runs the POST /users handler end to end (duplicate check, ReCaptcha, hash,
+# insert) against the given database, with ReCaptcha answered by the stub
+# backend after a fixed delay standing in for the round trip to Google. The
+# serial pipeline verifies ReCaptcha and then hashes the password, as the
+# handler used to; the overlapped pipeline is the current handler, which
+# hashes while ReCaptcha is being verified. The benchmark creates the User
+# tables in the target database, so point it at a scratch database.
+import argparse
+import time
+import uuid
+from benchutil import sqlite_json_support, summarize, print_table
+from flask import Flask, g
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from dm.base import Base
+from dm.User import User
+from dm.UserTrigram import UserTrigram # pylint: disable=W0611
+from api import users
+from util.hashing import HashExecutor
+from util.recaptcha import RECAPTCHA, StubRecaptchaBackend
+
+def user_json(tag):
+    """Returns a POST /users request body with unique keys"""
+    return {
+        'username': 'bench' + tag,
+        'password': 'benchmark-password',
+        'email': tag + '@bench.example',
+        'first_name': 'Bench',
+        'last_name': 'Mark',
+        'phone': tag[:20],
+        'reCaptchaResponse': 'Dummy',
+        'roles': 'User'
+    }
+
+def serial_post(user):
+    """Creates a user with the ReCaptcha check and the hash one after the other"""
+    check_user = g.db_session.query(User).filter(User.username == user['username']).one_or_none()
+    if check_user is not None:
+        return None, 400
+    if not RECAPTCHA.verify(user['reCaptchaResponse'], None):
+        return None, 401
+    new_user = User(user_id=uuid.uuid4().bytes, username=user['username'],
+                    email=user['email'], first_name=user['first_name'],
+                    last_name=user['last_name'], phone=user['phone'],
+                    roles=user['roles'], source='Local')
+    new_user.password_hash = users.HASHER.hash(user['password'])
+    g.db_session.add(new_user)
+    g.db_session.commit()
+    return None, 201
+
+def time_creates(app, session_factory, handler, count):
+    """Times count user creations through handler, returning the latencies"""
+    latencies = []
+    for _ in range(count):
+        body = user_json(uuid.uuid4().hex[:16])
+        with app.test_request_context('/users', method='POST'):
+            g.db_session = session_factory()
+            try:
+                start = time.time()
+                status = handler(body)[1]
+                latencies.append(time.time() - start)
+            finally:
+                g.db_session.close()
+        if status != 201:
+            raise RuntimeError('Create user returned ' + str(status))
+    return latencies
+
+def main():
+    """Runs the benchmark from the command line"""
+    parser = argparse.ArgumentParser(description='Benchmark create user latency')
+    parser.add_argument('--connect-string', default='sqlite:////tmp/bench_create_user.db',
+                        help='SQLAlchemy connect string for a scratch database')
+    parser.add_argument('--requests', type=int, default=100, help='Users created per pipeline')
+    parser.add_argument('--recaptcha-ms', type=float, default=100.0,
+                        help='Simulated ReCaptcha round trip, in milliseconds')
+    parser.add_argument('--executor', default='process', help="Hashing pool, 'process' or 'thread'")
+    parser.add_argument('--workers', type=int, default=None, help='Hashing workers')
+    args = parser.parse_args()
+
+    engine = sqlite_json_support(create_engine(args.connect_string))
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    app = Flask(__name__)
+    RECAPTCHA.backend = StubRecaptchaBackend(True, args.recaptcha_ms / 1000.0)
+    users.HASHER = HashExecutor(args.executor, args.workers)
+    # Warm up the hashing pool and the database connection
+    time_creates(app, session_factory, users.post, 2)
+
+    rows = []
+    for name, handler in [('serial', serial_post), ('overlapped', users.post)]:
+        row = summarize(time_creates(app, session_factory, handler, args.requests))
+        row['pipeline'] = name
+        rows.append(row)
+    users.HASHER.shutdown()
+    print_table(rows, ['pipeline', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'])
+
+if __name__ == '__main__':
+    main()
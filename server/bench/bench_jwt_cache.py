@@ -0,0 +1,118 @@
+"""bench_jwt_cache.py - Measures the per request savings of the verified JWT cache"""
+# Usage (from the project root):
+#   python3 server/bench/bench_jwt_cache.py --requests 2000
+#
+# Builds the real app on a fresh SQLite database, logs in one user and times
+# authenticated reads through the Flask test client, first with every request
+# verifying its token (as flask_jwt_extended does on its own) and then with
+# the verified JWT cache. The reads are the rehydrate (GET /login), a user
+# lookup (GET /users/{user_id}) and a username search (GET /users). Token
+# refreshes are pushed out with a low JWT_REFRESH_THRESHOLD, so every request
+# sends the same token, as a client does between refreshes. The time to
+# decode a token on its own, with and without the cache, is reported too.
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from benchutil import SRC_PATH, sqlite_json_support, print_table
+
+SPEC_PATH = os.path.join(SRC_PATH, '..', '..', 'openapi', 'olsnet.yaml')
+
+def configure_environ():
+    """Sets the server configuration for the benchmark before the server is imported"""
+    os.environ.update({
+        'CONNECT_STRING': 'sqlite:///' + tempfile.mktemp(suffix='.db', prefix='bench_jwt'),
+        'OPENAPI_SPEC': os.path.abspath(SPEC_PATH),
+        'APPSERVER_CONTAINER_PORT': '5999',
+        'SECRET_KEY': 'benchmark',
+        'RECAPTCHA_BACKEND': 'stub',
+        'OUTBOX_ENABLED': '0',
+        'PASSWORD_ROUNDS': '1000',
+        'JWT_REFRESH_THRESHOLD': '0'
+    })
+
+def time_requests(client, path, headers, count, repeats):
+    """Returns the best mean seconds per request over repeats"""
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(count):
+            resp = client.get(path, headers=headers)
+            if resp.status_code != 200:
+                raise RuntimeError('GET %s failed with %d' % (path, resp.status_code))
+        elapsed = (time.time() - start) / count
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def use_decode(decode):
+    """Makes the view decorators verify tokens with decode, behind the revocation check"""
+    from flask_jwt_extended import view_decorators
+    from util import revocation
+    view_decorators.decode_jwt = decode
+    revocation.install()
+
+def time_decode(decode, token, secret, count):
+    """Returns the mean seconds per call of a decode function"""
+    start = time.time()
+    for _ in range(count):
+        decode(token, secret, 'HS256', True)
+    return (time.time() - start) / count
+
+def main():
+    """Runs the benchmark from the command line"""
+    parser = argparse.ArgumentParser(description='Benchmark the verified JWT cache')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per variant, best is kept')
+    args = parser.parse_args()
+
+    configure_environ()
+    import server
+    from flask_jwt_extended.tokens import decode_jwt
+    from util.jwt_cache import JWT_CACHE, cached_decode_jwt
+    app = server.create_app().app
+    sqlite_json_support(server.ENGINE)
+    logging.disable(logging.INFO)
+
+    client = app.test_client()
+    user = {'username': 'jwtbench', 'password': 'benchmark-password',
+            'email': 'jwt@bench.example', 'phone': '9195550100',
+            'first_name': 'Jwt', 'last_name': 'Bench', 'roles': 'User',
+            'reCaptchaResponse': 'Dummy'}
+    resp = client.post('/api/v1/users', data=json.dumps(user), content_type='application/json')
+    user_id = json.loads(resp.get_data(as_text=True))['user_id']
+    resp = client.post('/api/v1/login', content_type='application/json',
+                       data=json.dumps({'username': user['username'],
+                                        'password': user['password']}))
+    cookies = {cookie.name: cookie.value for cookie in client.cookie_jar}
+    headers = {'X-CSRF-TOKEN': cookies['csrf_access_token']}
+
+    endpoints = [
+        ('GET /login', '/api/v1/login'),
+        ('GET /users/{user_id}', '/api/v1/users/' + user_id),
+        ('GET /users?search_text', '/api/v1/users?search_text=jwtb')
+    ]
+    rows = []
+    try:
+        for name, path in endpoints:
+            use_decode(decode_jwt)
+            uncached = time_requests(client, path, headers, args.requests, args.repeats)
+            use_decode(cached_decode_jwt)
+            cached = time_requests(client, path, headers, args.requests, args.repeats)
+            rows.append({'endpoint': name, 'verify_us': uncached * 1e6, 'cached_us': cached * 1e6,
+                         'saved_us': (uncached - cached) * 1e6,
+                         'saved_pct': 100.0 * (uncached - cached) / uncached})
+        token = cookies['access_token_cookie']
+        uncached = time_decode(decode_jwt, token, 'benchmark', args.requests)
+        cached = time_decode(cached_decode_jwt, token, 'benchmark', args.requests)
+        rows.append({'endpoint': 'decode only', 'verify_us': uncached * 1e6,
+                     'cached_us': cached * 1e6, 'saved_us': (uncached - cached) * 1e6,
+                     'saved_pct': 100.0 * (uncached - cached) / uncached})
+    finally:
+        server.shutdown()
+    print_table(rows, ['endpoint', 'verify_us', 'cached_us', 'saved_us', 'saved_pct'])
+    print('Token cache: %s' % JWT_CACHE.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""bench_serialize.py - Measures per row cost of serializing user search results"""
+# Usage (from the project root):
+#   python3 server/bench/bench_serialize.py --rows 10000
+#
+# Loads --rows synthetic users from an in-memory SQLite database and times
+# fetching and encoding them as a JSON array in several ways: the former
+# vars() based dump of ORM objects encoded with Flask's pretty printing
+# jsonify encoder, the compiled serializer on ORM objects, and the compiled
+# serializer on row tuples of only the serialized columns, each encoded with
+# the standard library and (if installed) with orjson.
+import argparse
+import json
+import time
+import uuid
+from benchutil import sqlite_json_support, print_table
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from dm.base import Base
+from dm.User import User, USER_SERIALIZER
+from dm.UserTrigram import UserTrigram # pylint: disable=W0611
+from util import fast_json
+
+def vars_dump(user):
+    """Returns the user dictionary the way User.dump used to build it"""
+    ret = {}
+    for key, value in vars(user).items():
+        if key == 'user_id':
+            ret[key] = user.get_uuid()
+        elif not (key.startswith('_') or key == 'password_hash'):
+            ret[key] = value
+    return ret
+
+def stdlib_pretty(value):
+    """Encodes like jsonify with pretty printing"""
+    return json.dumps(value, indent=2, separators=(', ', ': '), default=str).encode('utf-8')
+
+def stdlib_compact(value):
+    """Encodes with the standard library, compactly, as fast_json does without orjson"""
+    return fast_json.ENCODER.encode(value).encode('utf-8')
+
+def load_users(engine, count):
+    """Adds count synthetic users to the database"""
+    rows = []
+    for i in range(count):
+        rows.append({'user_id': uuid.uuid4().bytes, 'username': 'user%07d' % i,
+                     'email': 'user%07d@bench.example' % i, 'phone': '%010d' % i,
+                     'preferences': {'color': 'red', 'page_size': 50}, 'roles': 'User',
+                     'source': 'Local', 'first_name': 'First%d' % i, 'last_name': 'Last%d' % i,
+                     'password_hash': '$6$rounds=656000$' + 'x' * 86})
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), rows)
+
+def time_variant(session_factory, fetch, dump, encode, repeats):
+    """Returns the best seconds over repeats to fetch, dump and encode all users"""
+    best = None
+    for _ in range(repeats):
+        session = session_factory()
+        start = time.time()
+        encode([dump(row) for row in fetch(session)])
+        elapsed = time.time() - start
+        session.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    """Runs the benchmark from the command line"""
+    parser = argparse.ArgumentParser(description='Benchmark user search serialization')
+    parser.add_argument('--rows', type=int, default=10000, help='Users in the search result')
+    parser.add_argument('--repeats', type=int, default=5, help='Runs per variant, best is kept')
+    args = parser.parse_args()
+
+    engine = sqlite_json_support(create_engine('sqlite://'))
+    Base.metadata.create_all(engine)
+    load_users(engine, args.rows)
+    session_factory = sessionmaker(bind=engine)
+
+    def fetch_objects(session):
+        """Returns all users as ORM objects"""
+        return session.query(User).order_by(User.username).all()
+
+    def fetch_rows(session):
+        """Returns all users as row tuples of the serialized columns"""
+        return USER_SERIALIZER.query(session).order_by(User.username).all()
+
+    variants = [
+        ('objects, vars dump, pretty json', fetch_objects, vars_dump, stdlib_pretty),
+        ('objects, serializer, json', fetch_objects, USER_SERIALIZER.dump, stdlib_compact),
+        ('rows, serializer, json', fetch_rows, USER_SERIALIZER.dump_row, stdlib_compact)
+    ]
+    if fast_json.orjson is not None:
+        variants.append(('rows, serializer, orjson', fetch_rows, USER_SERIALIZER.dump_row,
+                         fast_json.dumps))
+    rows = []
+    for name, fetch, dump, encode in variants:
+        seconds = time_variant(session_factory, fetch, dump, encode, args.repeats)
+        rows.append({'variant': name, 'total_ms': seconds * 1000.0,
+                     'us_per_row': seconds * 1e6 / args.rows})
+    print_table(rows, ['variant', 'total_ms', 'us_per_row'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""benchutil.py - Shared helpers for the server benchmark scripts"""
+# Benchmarks are run from the project root, for example:
+#   python3 server/bench/bench_username_search.py --help
+# They import the server modules directly, so the server source directory
+# is added to the module path here.
+import os.path
+import sys
+from sqlalchemy import JSON
+from sqlalchemy.ext.compiler import compiles
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+# SQLAlchemy only has a JSON type for MySQL (and PostgreSQL), so benchmarks
+# running against SQLite store JSON columns as text
+@compiles(JSON, 'sqlite')
+def compile_sqlite_json(element, compiler, **kw): # pylint: disable=W0613
+    """Renders the JSON type as TEXT for SQLite"""
+    return 'TEXT'
+
+def sqlite_json_support(engine):
+    """Lets the JSON type serialize values on a SQLite engine"""
+    if engine.dialect.name == 'sqlite':
+        engine.dialect._json_serializer = None # pylint: disable=W0212
+        engine.dialect._json_deserializer = None # pylint: disable=W0212
+    return engine
+
+def percentile(values, pct):
+    """Returns the pct percentile (0-100) of a list of values, using nearest rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+def summarize(latencies):
+    """Returns count, mean and percentiles (in milliseconds) for latencies in seconds"""
+    count = len(latencies)
+    return {
+        'count': count,
+        'mean_ms': 1000.0 * sum(latencies) / count if count else 0.0,
+        'p50_ms': 1000.0 * percentile(latencies, 50),
+        'p95_ms': 1000.0 * percentile(latencies, 95),
+        'p99_ms': 1000.0 * percentile(latencies, 99)
+    }
+
+def print_table(rows, columns):
+    """Prints a list of dictionaries as a fixed width table with the given columns"""
+    widths = [max([len(col)] + [len(format_value(row[col])) for row in rows]) for col in columns]
+    print('  '.join(col.rjust(width) for col, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(format_value(row[col]).rjust(width) for col, width in zip(columns, widths)))
+
+def format_value(value):
+    """Formats a table value, limiting floats to two decimal places"""
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
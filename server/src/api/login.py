@@ -1,14 +1,22 @@
 """login.py - Module to handle /login API endpoint"""
 import uuid
-from flask import current_app, g, jsonify
+import logging
+from flask import g, jsonify
 from flask_jwt_extended import create_access_token, \
      jwt_required, \
      create_refresh_token, set_access_cookies, \
      set_refresh_cookies
 from facebook import GraphAPI
+from sqlalchemy.orm.exc import StaleDataError
 from util.api_util import api_error
+from util.conditional import stored_version, user_response
+from util.identity_cache import invalidate_user
+from util.metrics import REGISTRY
+from util.hashing import HashQueueFull
 from dm.User import User
 
+LOGGER = logging.getLogger(__name__)
+
 # Post method for login added 6/27/17 as part of moving from original
 # custom token generation scheme using HTTPAuth and basic authentication
 # to a JWT authentication method using flask_jwt_extended.
@@ -31,19 +39,33 @@ def post(login_data):
                            .one_or_none()
         if not user or not user.verify_password(login_data['password']):
             return api_error(401, 'INVALID_USERNAME_PASSWORD')
+        # Now that we have the password, upgrade the stored hash if it was
+        # made with a scheme or rounds that are no longer the current policy.
+        # The upgrade is optional, so if the hashing pool is full or another
+        # request changed the user meanwhile, it is left to the next login
+        if user.password_needs_update():
+            user_id = user.get_uuid()
+            try:
+                user.hash_password(login_data['password'])
+                g.db_session.commit()
+                invalidate_user(user_id)
+            except (HashQueueFull, StaleDataError) as err:
+                g.db_session.rollback()
+                LOGGER.warning('Skipped upgrading the password hash of user %s: %r', user_id, err)
 
     # This section handles facebook login, and I expect it to be tested manually,
     # so it is explicitly excluded from code coverage metrics
     elif 'access_token' in login_data: # pragma: no cover
         graph = GraphAPI(login_data['access_token'])
         if not graph:
-            current_app.logger.debug('Unable to instantiate graph GraphAPI object')
+            LOGGER.debug('Unable to instantiate graph GraphAPI object')
             return api_error(500, 'ERROR_FACEBOOK_MODULE')
-        profile = graph.get_object('me?fields=id,name,email,first_name,last_name')
+        with REGISTRY.timer('olsnet_external_call_seconds', {'service': 'facebook'}):
+            profile = graph.get_object('me?fields=id,name,email,first_name,last_name')
         if not profile:
-            current_app.logger.debug('Unable to get profile')
+            LOGGER.debug('Unable to get profile')
             return api_error(401, 'ERROR_FACEBOOK_PROFILE')
-        current_app.logger.debug('Cool - got %s', profile)
+        LOGGER.debug('Cool - got %s', profile)
         if not 'email' in profile:
             return api_error(401, 'ERROR_FACEBOOK_PRIVILEGES')
         user = g.db_session.query(User)\
@@ -92,4 +114,14 @@ def post(login_data):
 @jwt_required
 def search():
     """Handles GET verb for /login endpoint"""
-    return jsonify(g.user.dump()), 200
+    # The user usually comes from the identity cache, which can be behind
+    # changes made by other processes, so it is reloaded only if the stored
+    # row version differs; a client that has the current version then costs
+    # one small query and no serialization
+    user = g.user
+    if stored_version(g.db_session, user.user_id) != user.version_id:
+        user = g.db_session.query(User).populate_existing()\
+                           .filter(User.user_id == user.user_id).one_or_none()
+        if not user:
+            return api_error(404, 'USER_ID_NOT_FOUND', g.user.get_uuid())
+    return user_response(user)
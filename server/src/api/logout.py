@@ -1,11 +1,14 @@
 """logout.py - Module to handle /login API endpoint"""
 from flask_jwt_extended import jwt_required, \
-     unset_jwt_cookies
+     unset_jwt_cookies, get_raw_jwt
 from flask import jsonify
+from util.revocation import REVOCATIONS
 
 @jwt_required
 def post():
     """Handles POST verb for /logout endpoint. Should clear auth cookies"""
+    # Revoke the access token too, as the client may not be the only holder
+    REVOCATIONS.revoke(get_raw_jwt())
     resp = jsonify({})
     unset_jwt_cookies(resp)
     return resp, 200
@@ -0,0 +1,38 @@
+"""metrics.py - Implements the /metrics endpoint for Prometheus"""
+# Registered directly with Flask (see server.py), outside of the /api path
+# that the proxy forwards, and the proxy refuses /metrics as well. The
+# scraper must also send METRICS_KEY as a bearer token (bearer_token in the
+# Prometheus scrape config), as anyone who can reach the app server port
+# could otherwise read the metrics.
+#
+# Configured by environment variables:
+#   METRICS_KEY - Bearer token required to read the metrics; unset disables /metrics
+
+import hmac
+import os
+from flask import Response, request
+from util.api_util import api_error
+from util.metrics import EXPORTER
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_KEY = os.environ.get('METRICS_KEY') or None
+
+def authorized(header):
+    """Returns True if the Authorization header carries METRICS_KEY as a bearer token"""
+    scheme, _, token = (header or '').partition(' ')
+    # The key is compared as bytes, as compare_digest refuses strings that
+    # are not ASCII
+    return scheme.lower() == 'bearer' and\
+           hmac.compare_digest(token.strip().encode('utf-8'), METRICS_KEY.encode('utf-8'))
+
+def get():
+    """Handles GET verb for /metrics endpoint"""
+    if METRICS_KEY is None:
+        return api_error(404, 'METRICS_DISABLED')
+    if not authorized(request.headers.get('Authorization')):
+        resp = api_error(401, 'INVALID_METRICS_KEY')
+        resp.headers['WWW-Authenticate'] = 'Bearer realm="metrics"'
+        return resp
+    return Response(EXPORTER.render(), content_type=CONTENT_TYPE)
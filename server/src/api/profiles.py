@@ -0,0 +1,48 @@
+"""profiles.py - Implements the /profiles endpoints for request profiles (Admin only)"""
+from flask import g, Response
+from flask_jwt_extended import jwt_required
+from util.api_util import api_error
+from util.profiler import PROFILER
+from util.identity_cache import has_role
+
+@jwt_required
+def search():
+    """Handles GET verb for /profiles endpoint"""
+    if not has_role(g.db_session, g.user, 'Admin'):
+        return api_error(401, 'ADMIN_REQUIRED')
+    return {'settings': PROFILER.settings(), 'profiles': PROFILER.list()}, 200
+
+@jwt_required
+def put(settings):
+    """Handles PUT verb for /profiles endpoint"""
+    if not has_role(g.db_session, g.user, 'Admin'):
+        return api_error(401, 'ADMIN_REQUIRED')
+    # Changes only the server process that handles this request
+    if 'sample_rate' in settings:
+        PROFILER.sample_rate = settings['sample_rate']
+    if 'mode' in settings:
+        PROFILER.mode = settings['mode']
+    return PROFILER.settings(), 200
+
+@jwt_required
+def get(profile_id, format='json'): # pylint: disable=W0622
+    """Handles GET verb for /profiles/{profile_id} endpoint"""
+    if not has_role(g.db_session, g.user, 'Admin'):
+        return api_error(401, 'ADMIN_REQUIRED')
+    profile = PROFILER.get(profile_id)
+    if profile is None:
+        return api_error(404, 'PROFILE_NOT_FOUND', profile_id)
+    if format == 'json':
+        return profile.details(), 200
+    if format == 'pstats':
+        data = profile.pstats_data()
+        mimetype = 'application/octet-stream'
+    else:
+        data = profile.folded()
+        mimetype = 'text/plain'
+    if data is None:
+        return api_error(400, 'PROFILE_FORMAT_UNAVAILABLE', profile_id)
+    resp = Response(data, mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        profile_id, 'prof' if format == 'pstats' else 'folded')
+    return resp
@@ -2,14 +2,17 @@
 import uuid
 import datetime
 import random
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from flask import current_app, g, make_response
+import logging
+from flask import g, make_response
 from flask_jwt_extended import jwt_refresh_token_required, get_jwt_identity,\
                                create_refresh_token, set_refresh_cookies
 from dm.User import User
+from dm.Outbox import OutboxMessage
 from util.api_util import api_error
+from util.identity_cache import invalidate_user
+from util.mailer import OUTBOX
+
+LOGGER = logging.getLogger(__name__)
 
 # Error response constants
 EMAIL_NOT_FOUND = 'Email not found'
@@ -31,20 +34,22 @@ def post(reset_start):
     # Assign a reset code and expiration timestamp
     reset_user.reset_code = str(random.randint(100000, 999999))
     reset_user.reset_expires = datetime.datetime.now() + datetime.timedelta(minutes=15)
-    current_app.logger.debug('pw_reset POST - the reset code for ' + \
-                              reset_user.username + ' is ' + reset_user.reset_code)
+    # The code itself is not logged, since anyone with it can reset the password
+    LOGGER.debug('pw_reset POST - created a reset code for %s', reset_user.username)
+    # Queue the email in the same transaction as the reset code, so that it is
+    # only sent if the code is saved. The outbox sender delivers it after the
+    # commit, so this request does not wait on the mail server
     g.db_session.add(reset_user)
+    g.db_session.add(OutboxMessage(
+        sender='service@ourlifestories.net',
+        recipient=reset_start['email'],
+        subject='OurLifeStories.net Password Reset Code',
+        body_text="Here is your reset code: " + reset_user.reset_code,
+        body_html="<html><head></head><body>Here is your reset code: <strong>" +
+                  reset_user.reset_code + "</strong></body></html>"))
     g.db_session.commit()
-    # Need to put the email sending here
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = 'OurLifeStories.net Password Reset Code'
-    msg['From'] = 'service@ourlifestories.net'
-    msg['To'] = reset_start['email']
-    msg.attach(MIMEText("Here is your reset code: " + reset_user.reset_code, 'plain'))
-    msg.attach(MIMEText("<html><head></head><body>Here is your reset code: <strong>" +
-                        reset_user.reset_code + "</strong></body></html>", 'html'))
-    server = smtplib.SMTP('mail.ourlifestories.net')
-    server.sendmail(msg['From'], msg['To'], msg.as_string())
+    OUTBOX.wake()
+    invalidate_user(reset_user.get_uuid())
 
     # Add a refresh token (not an access_token) so that we confirm that the identity we generated
     # the reset code for is the same as the one using the reset code. Possibly redundant, but may
@@ -58,8 +63,10 @@ def post(reset_start):
 def put(reset_finish):
     """Method to handle PUT verb for /pw_reset endpoint"""
     user_id = get_jwt_identity()
-    current_app.logger.debug('pw_reset PUT - Have identity = ' + str(user_id))
-    reset_user = g.db_session.query(User)\
+    LOGGER.debug('pw_reset PUT - Have identity = %s', user_id)
+    # Populate existing so the reset code is checked against the stored row
+    # rather than the (possibly cached) identity loaded for the request
+    reset_user = g.db_session.query(User).populate_existing()\
                   .filter(User.user_id == uuid.UUID(user_id).bytes).one_or_none()
     # Do not need to check if the user exists here, because the refresh token required should
     # ensure that this is a valid identity
@@ -68,10 +75,8 @@ def put(reset_finish):
     # expired
     if reset_user.reset_code != reset_finish['reset_code'] or\
        reset_user.reset_expires < datetime.datetime.now():
-        current_app.logger.debug('reset_user.reset_code = ' + reset_user.reset_code)
-        current_app.logger.debug('reset_finish[reset_code] = ' + reset_finish['reset_code'])
-        current_app.logger.debug('reset_user.reset_expires = ' + str(reset_user.reset_expires))
-        current_app.logger.debug('datetime.datetime.now() = ' + str(datetime.datetime.now()))
+        LOGGER.debug('pw_reset PUT - rejected code for %s, code expires %s',
+                     reset_user.username, reset_user.reset_expires)
         return api_error(400, 'RESET_CODE_INVALID_OR_EXIRED')
     # Confirm the provided email matches the user that we're updating
     if reset_user.email != reset_finish['email']:
@@ -82,4 +87,5 @@ def put(reset_finish):
     reset_user.reset_expires = None
     g.db_session.add(reset_user)
     g.db_session.commit()
+    invalidate_user(user_id)
     return 'Password reset!', 200
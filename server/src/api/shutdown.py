@@ -1,4 +1,6 @@
 """shutdown.py - Implements API endpoint for /shutdown"""
+import os
+import signal
 from flask import request
 from util.api_util import api_error
 
@@ -14,4 +16,10 @@ def post(key):
 def shutdown_server():
     """Method to shut down the server"""
     func = request.environ.get('werkzeug.server.shutdown')
-    func()
+    if func is not None:
+        func()
+    elif request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        # Ask the gunicorn master to stop all of its workers gracefully
+        os.kill(os.getppid(), signal.SIGTERM)
+    else:
+        os.kill(os.getpid(), signal.SIGTERM)
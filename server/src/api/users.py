@@ -1,22 +1,39 @@
 """Module to handle /login API endpoint"""
 import uuid
 import os.path
-import requests
-from flask import g, current_app, request
+import logging
+from collections import OrderedDict
+from flask import g, request, Response, stream_with_context
 from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import jwt_required
-from dm.User import User
-from util.api_util import api_error
+from dm.User import User, USER_SERIALIZER
+from util.api_util import api_error, encode_cursor, decode_cursor
+from util.streaming import stream_json_array, stream_lines, ndjson_encoder, csv_encoder,\
+                           csv_header
+from util.fast_json import json_response, dumps
+from util.json_patch import merge_patch, json_update
+from util.bulk_import import import_users
+from util.name_search import filter_username_contains
+from util.identity_cache import invalidate_user, has_role
+from util.conditional import user_etag, stored_version, is_current, not_modified,\
+     user_response
+from util.recaptcha import RECAPTCHA, RecaptchaUnavailable
+from util.hashing import HASHER
 
-# API constants for Google ReCaptcha APIs
-RECAPTCHA_URL = 'https://www.google.com/recaptcha/api/siteverify'
-RECAPTCHA_KEY = '6LcUlxgUAAAAAK5wC6dv6XEcJFvtIbmJsFwyE3Hb'
+LOGGER = logging.getLogger(__name__)
 
-# We need to be able to mock the recaptcha check if we're running
-# in unit test mode (NODE_ENV='test').
-if 'NODE_ENV' in os.environ and os.environ['NODE_ENV'] == 'test':
-    print('We are running in test mode, ReCaptcha checks will be mocked')
-    import requests_mock
+# Search paging constants; page size is used when a page is requested with
+# after but no limit, and stream chunk size is the number of rows fetched per database round
+# trip when a search result is streamed
+SEARCH_PAGE_SIZE = 100
+SEARCH_STREAM_CHUNK_SIZE = 500
+
+# Rows fetched per database round trip by the export
+EXPORT_CHUNK_SIZE = 1000
+
+# Users created per batch by bulk import, unless the request sets batch_size
+BULK_IMPORT_BATCH_SIZE = int(os.environ.get('BULK_IMPORT_BATCH_SIZE', 500))
+BULK_IMPORT_MAX_BATCH_SIZE = 5000
 
 def post(user):
     """Method to handle POST verb for /user enpoint"""
@@ -28,24 +45,20 @@ def post(user):
     if 'roles' in user and 'Admin' in user['roles'] and\
        ('NODE_ENV' not in os.environ or os.environ['NODE_ENV'] != 'test'):
         return api_error(400, 'CANNOT_ASSIGN_ADMIN') # pragma: no cover
-    # Confirm ReCaptcha is valid
-    if 'NODE_ENV' in os.environ and os.environ['NODE_ENV'] == 'test':
-        with requests_mock.Mocker(real_http=True) as mock:
-            mock.post(RECAPTCHA_URL, json={'success': True})
-            resp = requests.post(RECAPTCHA_URL, data={
-                'secret': RECAPTCHA_KEY,
-                'response': user['reCaptchaResponse'],
-                'remoteip': request.remote_addr})
-    else:
-        resp = requests.post(RECAPTCHA_URL, data={
-            'secret': RECAPTCHA_KEY,
-            'response': user['reCaptchaResponse'],
-            'remoteip': request.remote_addr})   # pragma: no cover
-    current_app.logger.debug('Google Post Response Status: ' + str(resp.status_code))
-    current_app.logger.debug('Google Post Response JSON: ' + str(resp.json()))
-    if resp.status_code >= 400 or not resp.json()['success']:
+    # Start hashing the password on the hashing pool, and confirm ReCaptcha
+    # is valid on this thread while it runs (checked locally by the stub
+    # backend in unit test mode, see util/recaptcha.py). If the check fails
+    # the hash is cancelled, which frees its slot if it has not started yet
+    password_future = HASHER.submit('hash', user['password'])
+    try:
+        recaptcha_valid = RECAPTCHA.verify(user['reCaptchaResponse'], request.remote_addr)
+    except RecaptchaUnavailable:
+        password_future.cancel()
+        return api_error(503, 'API_RECAPTCHA_UNAVAILABLE')
+    if not recaptcha_valid:
+        password_future.cancel()
         return api_error(401, 'API_RECAPTCHA_FAILS')
-    current_app.logger.debug('user = ' + str(user))
+    LOGGER.debug('Creating user %s', user['username'])
     new_user = User(
         user_id=uuid.uuid4().bytes,
         username=user['username'],
@@ -57,7 +70,7 @@ def post(user):
         source='Local')
     if 'preferences' in user:
         new_user.preferences = user['preferences']
-    new_user.hash_password(user['password'])
+    new_user.password_hash = password_future.result()
     try:
         g.db_session.add(new_user)
         g.db_session.commit()
@@ -66,50 +79,88 @@ def post(user):
     return {'user_id': uuid.UUID(bytes=new_user.user_id)}, 201
 
 @jwt_required
-def search(search_text):
+def search(search_text=None, limit=None, after=None, stream=False):
     """Method to handle GET verb with no URL parameters"""
-    my_search = '%'
+    # Results are keyset paginated on username, so each page is a range scan
+    # on the username index starting after the last username of the prior page.
+    # Only the serialized columns are fetched, as row tuples rather than users
+    query = USER_SERIALIZER.query(g.db_session).order_by(User.username)
     if search_text:
-        my_search = '%' + search_text + '%'
-    user_list = g.db_session.query(User)\
-                 .filter(User.username.like(my_search))\
-                 .order_by(User.username)\
-                 .all()
-    ret = []
-    for user in user_list:
-        ret.append(user.dump())
-    return ret, 200
+        query = filter_username_contains(query, search_text)
+    if after:
+        try:
+            query = query.filter(User.username > decode_cursor(after))
+        except ValueError:
+            return api_error(400, 'INVALID_SEARCH_CURSOR', after)
+    # Streamed results are read from the database in chunks and written
+    # to the client as they are read, so the full result is never in memory.
+    # A request for neither a limit nor a page (as the client makes) gets
+    # every result, so it is streamed as well
+    if stream or not (limit or after):
+        if limit:
+            query = query.limit(limit)
+        return stream_json_array(query.yield_per(SEARCH_STREAM_CHUNK_SIZE),
+                                 USER_SERIALIZER.dump_row)
+    # Read one row beyond the page to find out if there is a next page
+    page_size = limit or SEARCH_PAGE_SIZE
+    user_list = query.limit(page_size + 1).all()
+    headers = {}
+    if len(user_list) > page_size:
+        user_list = user_list[:page_size]
+        headers['X-Next-Cursor'] = encode_cursor(user_list[-1].username)
+    return json_response([USER_SERIALIZER.dump_row(row) for row in user_list], 200, headers)
+
+@jwt_required
+def export(format='ndjson', gzip=False): # pylint: disable=W0622
+    """Handles GET verb for /users/export endpoint"""
+    if not has_role(g.db_session, g.user, 'Admin'):
+        return api_error(401, 'ADMIN_REQUIRED')
+    # yield_per reads through a server side cursor (with the MySQL drivers),
+    # so rows are written out as they arrive and never all held in memory
+    rows = USER_SERIALIZER.query(g.db_session).order_by(User.username)\
+                          .yield_per(EXPORT_CHUNK_SIZE)
+    filename = 'users.' + format + ('.gz' if gzip else '')
+    if format == 'csv':
+        return stream_lines(rows, csv_encoder(USER_SERIALIZER.fields, USER_SERIALIZER.dump_row),
+                            'text/csv', csv_header(USER_SERIALIZER.fields), gzip, filename)
+    return stream_lines(rows, ndjson_encoder(USER_SERIALIZER.dump_row), 'application/x-ndjson',
+                        compress=gzip, filename=filename)
 
 @jwt_required
 def delete(user_id):
     """Method to handle DELETE verb for /users/{user_id} endpoint"""
-    current_app.logger.debug('Delete user called with user_id = ' + user_id)
+    LOGGER.debug('Delete user called with user_id = %s', user_id)
     binary_uuid = uuid.UUID(user_id).bytes
     delete_user = g.db_session.query(User).filter(User.user_id == binary_uuid).one_or_none()
     if not delete_user:
         return api_error(404, 'USER_ID_NOT_FOUND', user_id)
     g.db_session.delete(delete_user)
     g.db_session.commit()
+    invalidate_user(user_id)
     return 'User deleted', 204
 
 @jwt_required
 def put(user_id, user):
     """Method to handle PUT verb for /users/{user_id} endpoint"""
     binary_uuid = uuid.UUID(user_id).bytes
-    update_user = g.db_session.query(User).filter(User.user_id == binary_uuid).one_or_none()
+    # Populate existing so that a user editing themselves gets the stored
+    # row rather than the (possibly cached) identity loaded for the request
+    update_user = g.db_session.query(User).populate_existing()\
+                   .filter(User.user_id == binary_uuid).one_or_none()
     if not update_user:
         return api_error(404, 'USER_ID_NOT_FOUND', user_id)
     # Allow Admin users to edit others without requiring a current password, 
     # and let Facebook users edit their information without requiring a password, 
     # but everyone else has to include their current password when making an edit
-    if not 'Admin' in g.user.roles and\
+    is_admin = has_role(g.db_session, g.user, 'Admin')
+    if not is_admin and\
        not g.user.source == 'Facebook' and\
        not g.user.verify_password(user['password']):
-        current_app.logger.debug('/users PUT: rejected missing current password')
+        LOGGER.debug('/users PUT: rejected missing current password')
         return api_error(401, 'MISSING_PASSWORD_EDIT')
-    if update_user.username != g.user.username and not 'Admin' in g.user.roles:
-        current_app.logger.debug('/users PUT: rejected update to %s by %s with roles %s' %\
-                                 (update_user.username, g.user.username, g.user.roles))
+    if update_user.username != g.user.username and not is_admin:
+        LOGGER.debug('/users PUT: rejected update to %s by %s with roles %s',
+                     update_user.username, g.user.username, g.user.roles)
         return api_error(401, 'UNAUTHORIZED_USER_EDIT')
     for key, value in user.items():
         if key != 'password' and key != 'newPassword':
@@ -118,13 +169,127 @@ def put(user_id, user):
             update_user.hash_password(value)
     g.db_session.add(update_user)
     g.db_session.commit()
+    invalidate_user(user_id)
+    return 'User updated', 200
+
+@jwt_required
+def patch(user_id, user):
+    """Handles PATCH verb for /users/{user_id} endpoint"""
+    binary_uuid = uuid.UUID(user_id).bytes
+    is_admin = has_role(g.db_session, g.user, 'Admin')
+    if (binary_uuid != g.user.user_id or 'roles' in user) and not is_admin:
+        return api_error(401, 'UNAUTHORIZED_USER_EDIT')
+    # The body is a merge patch of the user; password is the current
+    # password, which is checked rather than stored
+    changes = {key: value for key, value in user.items() if key != 'password'}
+    # Preferences are the user's own settings, so changing only them does not
+    # need the current password (and so no password hash)
+    if set(changes) - {'preferences'} and not is_admin and g.user.source != 'Facebook' and\
+       ('password' not in user or not g.user.verify_password(user['password'])):
+        LOGGER.debug('/users PATCH: rejected missing current password')
+        return api_error(401, 'MISSING_PASSWORD_EDIT')
+    # A few top level preferences are changed by the database where it can,
+    # without reading and writing back the whole preferences document
+    if list(changes) == ['preferences']:
+        update = json_update(g.db_session.get_bind().dialect.name, User.preferences,
+                             changes['preferences'])
+        if update is not None:
+            expression, condition = update
+            result = g.db_session.execute(
+                User.__table__.update().where(User.user_id == binary_uuid).where(condition)
+                .values(preferences=expression, version_id=User.version_id + 1))
+            g.db_session.commit()
+            if result.rowcount:
+                invalidate_user(user_id)
+                return 'User updated', 200
+    update_user = g.db_session.query(User).populate_existing()\
+                   .filter(User.user_id == binary_uuid).one_or_none()
+    if not update_user:
+        return api_error(404, 'USER_ID_NOT_FOUND', user_id)
+    for key, value in changes.items():
+        if key == 'preferences':
+            update_user.preferences = merge_patch(update_user.preferences, value)
+        elif key == 'newPassword':
+            update_user.hash_password(value)
+        else:
+            setattr(update_user, key, value)
+    try:
+        g.db_session.commit()
+    except IntegrityError:
+        return api_error(400, 'DUPLICATE_USER_KEY')
+    invalidate_user(user_id)
     return 'User updated', 200
 
 @jwt_required
 def get(user_id):
     """Handles GET verb for /users/{user_id} endpoint"""
-    binary_uuid = uuid.UUID(user_id).bytes
-    find_user = g.db_session.query(User).filter(User.user_id == binary_uuid).one_or_none()
+    user_uuid = uuid.UUID(user_id)
+    # A client that may already have the user gets its 304 from the stored
+    # row version alone, without loading the user. The identity cache is not
+    # used, as its copy can be behind changes made by other processes
+    if request.if_none_match:
+        version_id = stored_version(g.db_session, user_uuid.bytes)
+        if version_id is not None:
+            etag = user_etag(str(user_uuid), version_id)
+            if is_current(etag):
+                return not_modified(etag)
+    # The requesting user is already in the session, rebuilt from the
+    # identity cache, so the stored row replaces its possibly stale values
+    find_user = g.db_session.query(User).populate_existing()\
+                            .filter(User.user_id == user_uuid.bytes).one_or_none()
     if not find_user:
         return api_error(404, 'USER_ID_NOT_FOUND', user_id)
-    return find_user.dump(), 200
+    return user_response(find_user)
+
+@jwt_required
+def batch_get(batch):
+    """Handles POST verb for /users/batch_get endpoint"""
+    # Unparseable IDs cannot match a user, so they are reported missing
+    # rather than failing the whole batch
+    keys = OrderedDict()
+    for user_id in batch['ids']:
+        try:
+            keys[user_id] = uuid.UUID(user_id).bytes
+        except ValueError:
+            keys[user_id] = None
+    rows = USER_SERIALIZER.query(g.db_session)\
+                          .filter(User.user_id.in_(set(key for key in keys.values() if key)))\
+                          .all()
+    found = {row.user_id: USER_SERIALIZER.dump_row(row) for row in rows}
+    users = []
+    missing = []
+    for user_id, key in keys.items():
+        if key in found:
+            users.append(found[key])
+        else:
+            missing.append(user_id)
+    return json_response({'users': users, 'missing': missing})
+
+# POST /users/bulk is registered directly with Flask (see server.py) rather
+# than through the OpenAPI spec, because connexion reads the whole request
+# body before calling a handler. The body is newline delimited JSON, one user
+# per line, and is read a batch at a time while the per line results are
+# streamed back as newline delimited JSON, ending with a summary line.
+@jwt_required
+def bulk_import():
+    """Handles POST verb for /users/bulk endpoint"""
+    if not has_role(g.db_session, g.user, 'Admin'):
+        return api_error(401, 'ADMIN_REQUIRED')
+    try:
+        batch_size = int(request.args.get('batch_size', BULK_IMPORT_BATCH_SIZE))
+    except ValueError:
+        batch_size = 0
+    if not 1 <= batch_size <= BULK_IMPORT_MAX_BATCH_SIZE:
+        return api_error(400, 'INVALID_BATCH_SIZE', request.args.get('batch_size'))
+
+    def generate():
+        """Generator that yields one result line per input line"""
+        counts = {'created': 0, 'duplicate': 0, 'invalid': 0}
+        try:
+            for result in import_users(g.db_session, request.stream, batch_size, HASHER):
+                counts[result['status']] += 1
+                yield dumps(result) + b'\n'
+            yield dumps({'summary': counts}) + b'\n'
+        finally:
+            g.db_session.close()
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
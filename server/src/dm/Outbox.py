@@ -0,0 +1,38 @@
+"""Outbox.py - Module containing the outgoing email classes for the data model"""
+# Emails are not sent by request handlers. Instead a handler adds an
+# OutboxMessage in the same transaction as the change the email is about, and
+# a background sender (util/mailer.py) delivers it after the commit.
+import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from sqlalchemy import Column, DateTime, Index, Integer, String, Text
+from .base import Base
+
+class OutboxMessage(Base):
+    """Data model object representing an email waiting to be sent"""
+    __tablename__ = 'Outbox'
+    __table_args__ = (Index('ix_Outbox_status_next_attempt', 'status', 'next_attempt'),
+                      {'mysql_charset':'utf8'})
+    message_id = Column(Integer, primary_key=True)
+    sender = Column(String(120))
+    recipient = Column(String(120))
+    subject = Column(String(200))
+    body_text = Column(Text)
+    body_html = Column(Text)
+    status = Column(String(10), default='pending') # One of pending, sent, failed
+    attempts = Column(Integer, default=0) # Number of failed delivery attempts
+    created = Column(DateTime, default=datetime.datetime.now)
+    next_attempt = Column(DateTime, default=datetime.datetime.now) # Earliest time to try again
+    sent = Column(DateTime) # Timestamp the message was delivered
+    last_error = Column(String(500)) # Error from the last failed attempt
+
+    def as_mime(self):
+        """Returns the message as a MIME multipart email with text and html parts"""
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = self.subject
+        msg['From'] = self.sender
+        msg['To'] = self.recipient
+        msg.attach(MIMEText(self.body_text, 'plain'))
+        if self.body_html:
+            msg.attach(MIMEText(self.body_html, 'html'))
+        return msg
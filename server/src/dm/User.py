@@ -1,9 +1,18 @@
 """User.py - Module containing the user classes for the data model"""
 import uuid
-from sqlalchemy import Column, DateTime, JSON, String
+from sqlalchemy import Column, DateTime, Integer, JSON, String
 from sqlalchemy.dialects.mysql import BINARY
-from passlib.apps import custom_app_context as pwd_context
 from .base import Base
+from .password_policy import pwd_context
+from .serializer import ModelSerializer
+
+# User fields that may be returned by the API; password and reset data are not
+USER_FIELDS = ('user_id', 'username', 'email', 'phone', 'preferences', 'roles', 'source',
+               'first_name', 'last_name')
+
+def uuid_text(binary_uuid):
+    """Returns the text version of a binary UUID"""
+    return str(uuid.UUID(bytes=binary_uuid))
 
 class User(Base):
     """Data model object representing application user"""
@@ -21,6 +30,16 @@ class User(Base):
     reset_expires = Column(DateTime) # Expiration timestamp for refresh code
     first_name = Column(String(80)) # User first name
     last_name = Column(String(80)) # User last name
+    # Row version, counted up by every update made through the ORM; the
+    # ETags of user responses are built from it (see util/conditional.py)
+    version_id = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version_id}
+
+    # Object that hashes and verifies passwords, with the configured policy.
+    # The server replaces this with a worker pool (util/hashing.py) using the
+    # same policy, so hashing does not run on request threads
+    password_hasher = pwd_context
 
     def get_uuid(self):
         """Returns the text version of the UUID, the binary version is stored in the database"""
@@ -28,18 +47,18 @@ class User(Base):
 
     def dump(self):
         """Returns dictionary of fields and values"""
-        ret = {}
-        for key, value in vars(self).items():
-            if key == 'user_id':
-                ret[key] = self.get_uuid()
-            elif not (key.startswith('_') or key == 'password_hash'):
-                ret[key] = value
-        return ret
+        return USER_SERIALIZER.dump(self)
 
     def hash_password(self, password):
         """Create password hash from password string"""
-        self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = self.password_hasher.hash(password)
 
     def verify_password(self, password):
         """Verify password from password string"""
-        return pwd_context.verify(password, self.password_hash)
+        return self.password_hasher.verify(password, self.password_hash)
+
+    def password_needs_update(self):
+        """Returns True if the password hash should be recomputed with the current policy"""
+        return self.password_hasher.needs_update(self.password_hash)
+
+USER_SERIALIZER = ModelSerializer(User, USER_FIELDS, {'user_id': uuid_text})
@@ -0,0 +1,81 @@
+"""UserTrigram.py - Module containing the username trigram index for the data model"""
+# A substring search like username LIKE '%text%' cannot use the index on
+# User.username, so it scans the whole User table. This table holds one row
+# per distinct three character sequence (trigram) of each lower cased username,
+# which turns a substring search into index lookups on the trigrams of the
+# search text (see util/name_search.py). Rows are maintained by the mapper
+# event listeners below whenever a User is inserted, updated or deleted
+# through the ORM; bulk writes that bypass the ORM must call trigram_rows
+# themselves.
+from sqlalchemy import Column, Index, event, inspect, select
+from sqlalchemy.dialects.mysql import BINARY, VARBINARY
+from .base import Base
+from .User import User
+
+class UserTrigram(Base):
+    """Data model object representing one trigram posting for a username"""
+    __tablename__ = 'UserTrigram'
+    __table_args__ = (Index('ix_UserTrigram_user_id', 'user_id'), {'mysql_charset':'utf8'})
+    # Trigrams are stored as utf-8 bytes so that the database collation
+    # cannot treat two different trigrams as equal
+    trigram = Column(VARBINARY(12), primary_key=True)
+    user_id = Column(BINARY(16), primary_key=True)
+
+def trigrams(text):
+    """Returns the set of lower case trigrams (as utf-8 bytes) in a string"""
+    if not text:
+        return set()
+    text = text.lower()
+    return set(text[i:i + 3].encode('utf-8') for i in range(len(text) - 2))
+
+def trigram_rows(user_id, username):
+    """Returns the UserTrigram rows (as dictionaries) for a user id and username"""
+    return [{'trigram': trigram, 'user_id': user_id} for trigram in trigrams(username)]
+
+def _insert_trigrams(connection, target):
+    """Inserts the trigram rows for a user"""
+    rows = trigram_rows(target.user_id, target.username)
+    if rows:
+        connection.execute(UserTrigram.__table__.insert(), rows)
+
+def _delete_trigrams(connection, target):
+    """Deletes the trigram rows for a user"""
+    table = UserTrigram.__table__
+    connection.execute(table.delete().where(table.c.user_id == target.user_id))
+
+@event.listens_for(User, 'after_insert')
+def user_after_insert(mapper, connection, target): # pylint: disable=W0613
+    """Adds trigrams for a new user"""
+    _insert_trigrams(connection, target)
+
+@event.listens_for(User, 'after_update')
+def user_after_update(mapper, connection, target): # pylint: disable=W0613
+    """Replaces the trigrams for a user if the username changed"""
+    if inspect(target).attrs.username.history.has_changes():
+        _delete_trigrams(connection, target)
+        _insert_trigrams(connection, target)
+
+@event.listens_for(User, 'after_delete')
+def user_after_delete(mapper, connection, target): # pylint: disable=W0613
+    """Removes the trigrams for a deleted user"""
+    _delete_trigrams(connection, target)
+
+def rebuild_username_index(connection, batch_size=1000):
+    """Rebuilds the UserTrigram table from the User table, for existing databases"""
+    users = User.__table__
+    connection.execute(UserTrigram.__table__.delete())
+    last_id = None
+    while True:
+        query = select([users.c.user_id, users.c.username])\
+                .order_by(users.c.user_id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(users.c.user_id > last_id)
+        batch = connection.execute(query).fetchall()
+        if not batch:
+            break
+        rows = []
+        for user_id, username in batch:
+            rows.extend(trigram_rows(user_id, username))
+        if rows:
+            connection.execute(UserTrigram.__table__.insert(), rows)
+        last_id = batch[-1][0]
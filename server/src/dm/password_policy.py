@@ -0,0 +1,30 @@
+"""password_policy.py - The configured passlib policy for password hashes"""
+# The hashing policy is set by the environment, so that the cost of a login
+# can be tuned per deployment (see util/calibrate_hash.py):
+#   PASSWORD_SCHEMES - Comma separated passlib schemes. The first one hashes new
+#                      passwords, the others are deprecated and only verified
+#                      (default sha512_crypt,sha256_crypt, as custom_app_context)
+#   PASSWORD_ROUNDS - Rounds for the first scheme. Hashes made with any other
+#                     rounds are flagged for update (default passlib's policy)
+# Hashes that do not match the current policy are upgraded when the user next
+# logs in (see api/login.py). The policy lives with the data model so that
+# User hashes with it wherever the model is used, not only in the server.
+
+import os
+from passlib.apps import custom_app_context
+from passlib.context import CryptContext
+
+def build_context(schemes=None, rounds=None):
+    """Returns the passlib CryptContext for a list of schemes and default scheme rounds"""
+    if not schemes and not rounds:
+        return custom_app_context
+    schemes = schemes or custom_app_context.schemes()
+    options = {}
+    if rounds:
+        for setting in ['default_rounds', 'min_rounds', 'max_rounds']:
+            options[schemes[0] + '__' + setting] = rounds
+    return CryptContext(schemes=schemes, default=schemes[0], deprecated='auto', **options)
+
+pwd_context = build_context(
+    [scheme.strip() for scheme in os.environ.get('PASSWORD_SCHEMES', '').split(',') if scheme.strip()],
+    int(os.environ.get('PASSWORD_ROUNDS', 0)) or None)
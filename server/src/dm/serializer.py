@@ -0,0 +1,44 @@
+"""serializer.py - Converts data model objects to dictionaries for API responses"""
+# A ModelSerializer is built once per model from an explicit list of the
+# table's columns, so only allow-listed fields ever reach a response and the
+# per-row work is a single attribute fetch plus any field conversions. It can
+# also build a query for just those columns, whose row tuples it dumps the
+# same way without the cost of loading ORM objects.
+from operator import attrgetter
+
+class ModelSerializer(object):
+    """Dumps model objects, or row tuples of their columns, to dictionaries"""
+
+    def __init__(self, model, fields, converters=None):
+        columns = model.__table__.columns
+        unknown = [name for name in fields if name not in columns]
+        if unknown:
+            raise ValueError('Fields ' + ', '.join(unknown) + ' are not columns of ' +
+                             model.__tablename__)
+        converters = converters or {}
+        self.model = model
+        self.fields = tuple(fields)
+        self.columns = tuple(getattr(model, name) for name in self.fields)
+        self._get_values = attrgetter(*self.fields)
+        self._converters = tuple((name, converters[name]) for name in self.fields
+                                 if name in converters)
+
+    def query(self, session):
+        """Returns a query for the serialized columns, whose rows dump_row accepts"""
+        return session.query(*self.columns)
+
+    def dump(self, obj):
+        """Returns a dictionary of the serialized fields of a model object"""
+        values = self._get_values(obj)
+        if len(self.fields) == 1:
+            values = (values,)
+        return self.dump_row(values)
+
+    def dump_row(self, row):
+        """Returns a dictionary of the serialized fields from a row tuple"""
+        ret = dict(zip(self.fields, row))
+        for name, convert in self._converters:
+            value = ret[name]
+            if value is not None:
+                ret[name] = convert(value)
+        return ret
@@ -0,0 +1,67 @@
+"""gunicorn_conf.py - gunicorn settings for serving the API with several workers"""
+# Used as: gunicorn -c /app/gunicorn_conf.py wsgi:application
+#
+# There are two serving modes, chosen by SERVER_MODE:
+#   sync (default) - Each worker serves GUNICORN_THREADS requests at a time on
+#       OS threads.
+#   async - Each worker runs on the gevent event loop and serves up to
+#       GUNICORN_WORKER_CONNECTIONS requests at a time as greenlets. The
+#       handlers are unchanged: gunicorn patches the standard library before
+#       the app is loaded, so waits on sockets (MySQL through the PyMySQL
+#       driver, ReCaptcha and Facebook through requests, SMTP through
+#       smtplib) and sleeps yield to other requests instead of blocking a
+#       thread. See server/bench/bench_serving_modes.py.
+#
+# Configured by environment variables:
+#   APPSERVER_CONTAINER_PORT - Port to listen on
+#   SERVER_MODE - 'sync' or 'async'
+#   GUNICORN_WORKERS - Worker processes (default 2 per CPU plus 1)
+#   GUNICORN_THREADS - Request threads per sync worker (default 4)
+#   GUNICORN_WORKER_CONNECTIONS - Concurrent requests per async worker (default 1000)
+#   GUNICORN_TIMEOUT - Seconds a silent worker may run before it is restarted (default 30)
+#   GUNICORN_GRACEFUL_TIMEOUT - Seconds workers get to finish requests on shutdown (default 30)
+#
+# Each worker keeps its own metrics, so set METRICS_DIR for /metrics to
+# report the totals of all of the workers (see util/metrics.py).
+#
+# SIGTERM or SIGINT to the gunicorn master stops the workers gracefully, and
+# SIGHUP reloads them. The app is not preloaded in the master, so nothing
+# that holds connections or threads (the database pool, the outbox sender,
+# the hashing pool) is shared across a fork.
+# The master does set up the database schema once, before
+# the workers start, so that they do not all run it at the same time (see
+# schema.py).
+import multiprocessing
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__)) # pylint: disable=C0103
+bind = '0.0.0.0:' + os.environ.get('APPSERVER_CONTAINER_PORT', '5000') # pylint: disable=C0103
+workers = int(os.environ.get('GUNICORN_WORKERS', 0)) or multiprocessing.cpu_count() * 2 + 1 # pylint: disable=C0103
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) # pylint: disable=C0103
+if os.environ.get('SERVER_MODE', 'sync') == 'async':
+    worker_class = 'gevent' # pylint: disable=C0103
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)) # pylint: disable=C0103
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30)) # pylint: disable=C0103
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30)) # pylint: disable=C0103
+# nginx keeps connections to the workers open between requests
+keepalive = 75 # pylint: disable=C0103
+preload_app = False # pylint: disable=C0103
+accesslog = '-' # pylint: disable=C0103
+
+def on_starting(arbiter): # pylint: disable=W0613
+    """Sets up the database schema in the master before any worker is forked"""
+    import schema
+    schema.migrate()
+    # Inherited by the workers, whose create_app() then skips the schema
+    os.environ['SCHEMA_READY'] = '1'
+
+def post_fork(arbiter, worker): # pylint: disable=W0613
+    """Starts a process hashing pool before the worker starts its request threads"""
+    from util.hashing import HASHER
+    if HASHER.kind == 'process':
+        HASHER.start()
+
+def worker_exit(arbiter, worker): # pylint: disable=W0613
+    """Stops the worker's background threads and pools as it exits"""
+    import server
+    server.shutdown()
@@ -0,0 +1,52 @@
+"""schema.py - Creates and upgrades the database schema"""
+# Creates any missing tables, adds columns that older databases lack and
+# indexes the usernames already there when the username index is new. This
+# must run in one process before any serve requests: run concurrently,
+# create_all, the ALTER TABLE and the index rebuild race each other. The
+# development server (server.py) runs it from create_app(); under gunicorn
+# the master runs it once before forking the workers (see on_starting in
+# gunicorn_conf.py) and sets SCHEMA_READY so that the workers skip it. It
+# can also be run on its own as a migration step:
+#   python3 /app/schema.py
+import logging
+import os
+from sqlalchemy import create_engine, exc, inspect
+from dm.base import Base
+from dm.Outbox import OutboxMessage # pylint: disable=W0611
+from dm.UserTrigram import rebuild_username_index
+
+LOGGER = logging.getLogger(__name__)
+
+def setup_schema(engine):
+    """Creates any missing tables and columns, indexing existing usernames if needed"""
+    try:
+        # An existing database from before the username index needs the users
+        # that are already there indexed once the new table is created
+        needs_username_index = engine.dialect.has_table(engine, 'User') and\
+                               not engine.dialect.has_table(engine, 'UserTrigram')
+        # Creates only the tables that do not exist yet
+        Base.metadata.create_all(engine)
+        # An existing User table from before row versions needs the column,
+        # which starts at 1 for the users that are already there
+        if 'version_id' not in [column['name'] for column in
+                                inspect(engine).get_columns('User')]:
+            with engine.begin() as connection:
+                connection.execute('ALTER TABLE %s ADD COLUMN version_id INTEGER NOT NULL DEFAULT 1'
+                                   % engine.dialect.identifier_preparer.quote('User'))
+        if needs_username_index:
+            with engine.begin() as connection:
+                rebuild_username_index(connection)
+    except exc.SQLAlchemyError: # pragma: no cover
+        LOGGER.exception('Caught an exception in schema setup')
+
+def migrate():
+    """Sets up the schema of the CONNECT_STRING database on a short lived engine"""
+    engine = create_engine(os.environ['CONNECT_STRING'])
+    try:
+        setup_schema(engine)
+    finally:
+        engine.dispose()
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    migrate()
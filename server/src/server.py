@@ -1,21 +1,47 @@
-# pylint: disable=R1703
-# Note: disabling the pylint whine about how I'm setting DEBUG_APP
+# pylint: disable=R1703,W0603
+# Note: disabling the pylint whine about how I'm setting DEBUG_APP, and
+# about create_app setting the module level engine and session globals
 """Server.py - Creates API server"""
-import uuid
+# The app is built by create_app(). Run this file directly for the
+# single process development server, or serve wsgi.py with gunicorn
+# (see gunicorn_conf.py) to run several worker processes, each of which
+# builds its own app and database engine after it is forked.
 import os.path
 import logging
+import time
 import connexion
 from connexion.resolver import RestyResolver
-from flask_jwt_extended import JWTManager, create_access_token, set_access_cookies
+from flask_jwt_extended import JWTManager, create_access_token, set_access_cookies, get_raw_jwt
 from flask import request, g, abort
-from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
-from dm.base import Base
+from sqlalchemy.orm.exc import StaleDataError
 from dm.User import User
+from api import users, metrics
+from util.identity_cache import load_user
+from util.hashing import HASHER, HashQueueFull
+from util.mailer import OUTBOX
+from util.api_util import api_error
+from util.lazy_session import LazySession, SESSION_USAGE, track_connection_use
+from util.db_pool import POOL_MONITOR, pool_options, warm_up
+from util.metrics import REGISTRY, EXPORTER
+from util.instrumentation import instrument_engine, component_collector, start_request,\
+     record_response, finish_request, request_status, operation_name
+from util.profiler import PROFILER
+from util.log_config import LOGGING
+from util import jwt_cache, revocation
+from schema import setup_schema
 
 # Define constants
 API_REQUIRES_JSON = 'All PUT/POST API requests require JSON, and this request did not'
 OTHER_PRECHECK_401 = 'Other 401 response'
+# Full request paths (request.path includes the /api/v1 base path) whose
+# POST bodies need not be JSON
+NON_JSON_PATHS = ['/api/v1/shutdown', '/api/v1/users/bulk']
+# Access tokens are re-issued only once they have fewer than this many
+# seconds left, rather than on every authenticated response
+JWT_REFRESH_THRESHOLD = int(os.environ.get('JWT_REFRESH_THRESHOLD', 600))
 
 # Get the spec file from the environment variable
 OPENAPI_SPEC = os.environ['OPENAPI_SPEC']
@@ -26,131 +52,227 @@ if 'FLASK_DEBUG' in os.environ and int(os.environ['FLASK_DEBUG']) == 1:
 else:
     DEBUG_APP = False
 
-# Create the connextion-based Flask app, and tell it where to look for API specs
-APP = connexion.FlaskApp(__name__, specification_dir='swagger/', swagger_json=True, debug=DEBUG_APP)
-FAPP = APP.app
-# JWT implementation
-JWT = JWTManager(FAPP)
-
-# Add our specific API spec, and tell it to use the Resty resolver to find the
-# specific python module to handle the API call by navigating the source tree
-# according to the API structure. All API modules are in the "api" directory
-APP.add_api(OPENAPI_SPEC, resolver=RestyResolver('api'))
-
-# Get a reference to the logger for the app
-LOGGER = FAPP.logger
-# Set debug logging
-LOGGER.setLevel(logging.DEBUG)
-# Set the app into debug mode
-FAPP.debug = True
-
-# Get the database connect string from the environment
+# Get the database connect string and port from the environment
 CONNECT_STRING = os.environ['CONNECT_STRING']
-LOGGER.debug('Connect String = ' + CONNECT_STRING)
+# The mysqlclient driver is a C library that blocks the whole process while
+# it waits on MySQL, so the async serving mode (see gunicorn_conf.py) uses
+# the pure python PyMySQL driver, whose socket waits gevent makes cooperative
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
+if SERVER_MODE == 'async':
+    CONNECT_STRING = CONNECT_STRING.replace('mysql+mysqldb://', 'mysql+pymysql://', 1)
 APPSERVER_PORT = os.environ['APPSERVER_CONTAINER_PORT']
-LOGGER.debug('Running on port: ' + APPSERVER_PORT)
-
-# Get the secret key from the environment
-FAPP.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-
-# Set JWT configuration options
-# Configure application to store JWTs in cookies
-FAPP.config['JWT_TOKEN_LOCATION'] = ['cookies']
-# Only allow JWT cookies to be sent over https. In production, this
-# should likely be True
-FAPP.config['JWT_COOKIE_SECURE'] = False
-# Set the cookie paths, so that you are only sending your access token
-# cookie to the access endpoints, and only sending your refresh token
-# to the refresh endpoint. Technically this is optional, but it is in
-# your best interest to not send additional cookies in the request if
-# they aren't needed.
-FAPP.config['JWT_ACCESS_COOKIE_PATH'] = '/'
-FAPP.config['JWT_REFRESH_COOKIE_PATH'] = '/api/v1/pw_reset'
-# Enable csrf double submit protection. See this for a thorough
-# explination: http://www.redotheweb.com/2015/11/09/api-security.html
-FAPP.config['JWT_COOKIE_CSRF_PROTECT'] = True
-# Ensure that CSRF protection covers GET operations as well as those
-# that describe state change; flask_jwt_extended defaults to only covering
-# state change operations
-FAPP.config['JWT_CSRF_METHODS'] = ['POST', 'PUT', 'PATCH', 'DELETE', 'GET']
-
-# Create database connection and sessionmaker
-try:
-    ENGINE = create_engine(CONNECT_STRING, pool_recycle=3600)
-except exc.SQLAlchemyError: # pragma: no cover
-    LOGGER.debug('Caught exception in create_engine: ' + exc.SQLAlchemyError)
-try:
-    DBSESSION = sessionmaker(bind=ENGINE)
-except exc.SQLAlchemyError: # pragma: no cover
-    LOGGER.debug('Caught an exception in sessionmaker' + exc.SQLAlchemyError)
-LOGGER.debug('We have created a session')
-try:
-    if not ENGINE.dialect.has_table(ENGINE, 'User'):
-        Base.metadata.create_all(ENGINE)
-except exc.SQLAlchemyError: # pragma: no cover
-    LOGGER.debug('Caught an exception in schema setup' + exc.SQLAlchemyError)
+
+# Database engine and session factory, created by create_app in the
+# process that serves requests
+ENGINE = None
+DBSESSION = None
+LOGGER = logging.getLogger(__name__)
+
+def create_app():
+    """Creates the connexion app with its database engine, returning the app"""
+    global ENGINE, DBSESSION, LOGGER
+
+    # Log through the queue to the writer thread, at the configured levels
+    LOGGING.start()
+
+    # Create the connextion-based Flask app, and tell it where to look for API specs
+    app = connexion.FlaskApp(__name__, specification_dir='swagger/', swagger_json=True,
+                             debug=DEBUG_APP)
+    fapp = app.app
+
+    # Add our specific API spec, and tell it to use the Resty resolver to find the
+    # specific python module to handle the API call by navigating the source tree
+    # according to the API structure. All API modules are in the "api" directory
+    app.add_api(OPENAPI_SPEC, resolver=RestyResolver('api'))
+    # Bulk user import streams its request body, which connexion would read
+    # into memory before calling the handler, so it is routed by Flask
+    fapp.add_url_rule('/api/v1/users/bulk', 'users_bulk_import', users.bulk_import,
+                      methods=['POST'])
+    # Prometheus metrics for every worker process of this server, read with
+    # the METRICS_KEY bearer token (see api/metrics.py)
+    fapp.add_url_rule('/metrics', 'metrics', metrics.get)
+
+    # Get a reference to the logger for the app, whose records (including
+    # those of unhandled exceptions) go through the logging queue too
+    LOGGER = fapp.logger
+    LOGGING.adopt(LOGGER)
+    # The URL's repr leaves out the password
+    LOGGER.debug('Connect String = %r', make_url(CONNECT_STRING))
+    LOGGER.debug('Running on port: %s', APPSERVER_PORT)
+
+    configure_jwt(fapp)
+
+    # Create database connection and sessionmaker
+    try:
+        ENGINE = instrument_engine(POOL_MONITOR.attach(
+            create_engine(CONNECT_STRING, **pool_options(CONNECT_STRING))))
+    except exc.SQLAlchemyError: # pragma: no cover
+        LOGGER.exception('Caught exception in create_engine')
+    try:
+        DBSESSION = track_connection_use(sessionmaker(bind=ENGINE))
+    except exc.SQLAlchemyError: # pragma: no cover
+        LOGGER.exception('Caught an exception in sessionmaker')
+    LOGGER.debug('We have created a session')
+    # gunicorn's master sets up the schema once before forking the workers
+    if os.environ.get('SCHEMA_READY') != '1':
+        setup_schema(ENGINE)
+    # Open the pooled connections now rather than on the first requests
+    try:
+        warm_up(ENGINE)
+    except exc.SQLAlchemyError: # pragma: no cover
+        LOGGER.warning('Unable to warm up the database connection pool')
+
+    # Start delivering queued emails in the background
+    OUTBOX.start(DBSESSION)
+
+    # Report component stats with the request metrics, and share this
+    # process's metrics with the other worker processes
+    REGISTRY.add_collector(component_collector(pool_stats))
+    EXPORTER.start()
+
+    # Load the revoked tokens, and pick up those revoked by other workers
+    revocation.REVOCATIONS.start()
+
+    # Hash and verify passwords on the hashing worker pool rather than on
+    # the request thread
+    User.password_hasher = HASHER
+
+    # Shed load when the hashing pool is saturated rather than queueing
+    # requests without bound
+    fapp.register_error_handler(HashQueueFull, hash_queue_full)
+    # Two requests updating the same user at once: the one that commits
+    # second finds the row version changed under it
+    fapp.register_error_handler(StaleDataError, user_changed)
+    fapp.before_request(before_request)
+    fapp.after_request(after_request)
+    fapp.teardown_request(teardown_request)
+    return app
+
+def configure_jwt(fapp):
+    """Sets the secret key and JWT configuration options for the Flask app"""
+    # Get the secret key from the environment
+    fapp.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+
+    # Set JWT configuration options
+    # Configure application to store JWTs in cookies
+    fapp.config['JWT_TOKEN_LOCATION'] = ['cookies']
+    # Only allow JWT cookies to be sent over https. In production, this
+    # should likely be True
+    fapp.config['JWT_COOKIE_SECURE'] = False
+    # Set the cookie paths, so that you are only sending your access token
+    # cookie to the access endpoints, and only sending your refresh token
+    # to the refresh endpoint. Technically this is optional, but it is in
+    # your best interest to not send additional cookies in the request if
+    # they aren't needed.
+    fapp.config['JWT_ACCESS_COOKIE_PATH'] = '/'
+    fapp.config['JWT_REFRESH_COOKIE_PATH'] = '/api/v1/pw_reset'
+    # Enable csrf double submit protection. See this for a thorough
+    # explination: http://www.redotheweb.com/2015/11/09/api-security.html
+    fapp.config['JWT_COOKIE_CSRF_PROTECT'] = True
+    # Ensure that CSRF protection covers GET operations as well as those
+    # that describe state change; flask_jwt_extended defaults to only covering
+    # state change operations
+    fapp.config['JWT_CSRF_METHODS'] = ['POST', 'PUT', 'PATCH', 'DELETE', 'GET']
+
+    # JWT implementation
+    jwt = JWTManager(fapp)
+    jwt.user_loader_callback_loader(user_loader_callback)
+    # Verify each access token once, rather than on every request
+    jwt_cache.install()
+    # Refuse access tokens revoked by logging out
+    revocation.install()
+
+def hash_queue_full(err): # pylint: disable=W0613
+    """Responds with a 503 when a password hashing operation is shed"""
+    resp = api_error(503, 'HASH_QUEUE_FULL')
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+def user_changed(err): # pylint: disable=W0613
+    """Responds with a 409 when a user was updated by another request first"""
+    g.db_session.rollback()
+    return api_error(409, 'USER_CHANGED')
 
 # This method ensures that we have a user object both in global and
 # in the current_user proxy from flask-jwt-extended
-@JWT.user_loader_callback_loader
 def user_loader_callback(identity):
     """Callback to load user object for requests where jwt_identity is required"""
-    g.user = g.db_session.query(User)\
-                         .filter(User.user_id == uuid.UUID(identity).bytes)\
-                         .one_or_none()
+    g.user = load_user(g.db_session, identity)
     if not g.user:
         return None
     return g.user
 
 # Need to make sure that the use of the database session is
 # scoped to the request to avoid open orm transactions between requests
-@FAPP.before_request
 def before_request():
     """Method to do work before the request"""
-    # Ensure there is a database session available for the request
-    g.db_session = DBSESSION()
+    start_request()
+    # Profiling is opt in per request (see util/profiler.py)
+    profile = PROFILER.start(request.headers)
+    if profile is not None:
+        g.profile = profile
+
+    # Ensure there is a database session available for the request; it is
+    # only created (and only checks out a connection) if the request uses it
+    g.db_session = LazySession(DBSESSION)
 
-    # Confirm that any POST or PUT includes JSON (except logout)
-    if (request.method == 'POST' or request.method == 'PUT') and \
-        not request.is_json and request.path != '/shutdown':
-        if request.path != '/fb_login':
+    # Confirm that any POST, PUT or PATCH includes JSON (except to NON_JSON_PATHS)
+    if request.method in ('POST', 'PUT', 'PATCH') and \
+        not request.is_json and request.path not in NON_JSON_PATHS:
+        if request.path != '/api/v1/fb_login':
             abort(400, API_REQUIRES_JSON)
         else:
             abort(401, OTHER_PRECHECK_401)
 
-@FAPP.after_request
 def after_request(resp):
     """Method to do work after the request"""
-    # If we have a valid response, create a new access_token to
-    # reset the 15 minute clock
+    # If we have a valid response and the access token is close to expiring,
+    # create a new access_token to reset the 15 minute clock
     if (resp.status_code) < 400 and 'user' in g and\
-       not request.path in ['/api/v1/logout', '/api/v1/shutdown']:
+       not request.path in ['/api/v1/logout', '/api/v1/shutdown'] and access_token_expiring():
         access_token = create_access_token(identity=g.user.get_uuid())
         set_access_cookies(resp, access_token)
     g.db_session.close()
+    record_response(resp)
+    if 'profile' in g:
+        resp.headers['X-Profile-Id'] = g.profile.profile_id
     return resp
 
-# Need to recover if the sql server has closed the connection
-# due to a timeout or other reason
-@event.listens_for(ENGINE, "engine_connect")
-def ping_connection(connection, branch): # pragma: no cover
-    """Method to check if database connection is active """
-    if branch:
-        return
+def access_token_expiring():
+    """Returns True if the request's token should be replaced with a new access token"""
+    # The token was decoded by jwt_required, so this only reads its claims.
+    # Other kinds of token, such as the refresh token of a password reset,
+    # are always exchanged for an access token
+    claims = get_raw_jwt()
+    if claims.get('type') != 'access' or claims['exp'] - time.time() < JWT_REFRESH_THRESHOLD:
+        REGISTRY.inc('olsnet_token_refreshes_total', {'result': 'refreshed'})
+        return True
+    REGISTRY.inc('olsnet_token_refreshes_total', {'result': 'skipped'})
+    return False
 
-    save_should_close_with_result = connection.should_close_with_result
-    connection.should_close_with_result = False
+def teardown_request(err):
+    """Method to do work once the response, including any streamed body, is done"""
+    if 'db_session' in g:
+        SESSION_USAGE.record(g.db_session)
+    finish_request(err)
+    if 'profile' in g:
+        PROFILER.finish(g.profile, request.method, request.path, operation_name(),
+                        request_status(err))
 
-    try:
-        connection.scalar(select([1]))
-    except exc.DBAPIError as err:
-        if err.connection_invalidated:
-            LOGGER.info("Recovering from connection_invalidated")
-            connection.scalar(select([1]))
-        else:
-            raise
-    finally:
-        connection.should_close_with_result = save_should_close_with_result
+def pool_stats():
+    """Returns the database connection pool statistics for this process"""
+    return POOL_MONITOR.stats(ENGINE)
+
+def shutdown():
+    """Stops background work so the process can exit cleanly"""
+    OUTBOX.stop()
+    EXPORTER.stop()
+    revocation.REVOCATIONS.stop()
+    HASHER.shutdown()
+    if ENGINE is not None:
+        ENGINE.dispose()
+    LOGGING.stop()
 
-# Start the app
-APP.run(host='0.0.0.0', port=int(APPSERVER_PORT))
+# Start the app with the development server
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=int(APPSERVER_PORT))
@@ -2,7 +2,10 @@
 # The intent of this module is to provide shared utility code that works across APIs
 # api_error - Enables internationalization / localization of error messages in the UI by
 #             returning a set of error codes as well as default english error messages
+# encode_cursor / decode_cursor - Opaque keyset pagination cursors for list APIs
 
+import base64
+import binascii
 from flask import jsonify
 
 API_ERRORS = {
@@ -20,9 +23,19 @@ API_ERRORS = {
     "DUPLICATE_USER_KEY": 'Key value (e.g. email, phone) is already in use for another user',
     "CANNOT_ASSIGN_ADMIN": 'Cannot assign Admin role during user creation',
     "API_RECAPTCHA_FAILS": 'ReCaptcha check failed',
+    "API_RECAPTCHA_UNAVAILABLE": 'ReCaptcha check is unavailable right now, please retry',
     "USER_ID_NOT_FOUND": 'User ID {} not found',
     "MISSING_PASSWORD_EDIT": 'Current password must be provided to edit user data',
-    "UNAUTHORIZED_USER_EDIT": 'Cannot edit other users data unless you have the Admin role'
+    "UNAUTHORIZED_USER_EDIT": 'Cannot edit other users data unless you have the Admin role',
+    "INVALID_SEARCH_CURSOR": 'The search cursor {} is not valid',
+    "ADMIN_REQUIRED": 'This operation requires the Admin role',
+    "INVALID_BATCH_SIZE": 'The batch size {} is not valid',
+    "PROFILE_NOT_FOUND": 'Profile {} not found, it may have been replaced by newer profiles',
+    "PROFILE_FORMAT_UNAVAILABLE": 'Profile {} is not available in the requested format',
+    "HASH_QUEUE_FULL": 'The server is too busy to check passwords right now, please retry',
+    "USER_CHANGED": 'The user was changed by another request at the same time, please reload and retry',
+    "METRICS_DISABLED": 'Metrics are disabled, set METRICS_KEY to enable them',
+    "INVALID_METRICS_KEY": 'Reading metrics requires the metrics key as a bearer token'
 }
 
 # Error response constants
@@ -47,4 +60,15 @@ def api_error_msg(msg_key, msg_text):
         else:
             return API_ERRORS[msg_key]
     else:
-        return "Unknown error key: " + msg_key
\ No newline at end of file
+        return "Unknown error key: " + msg_key
+
+def encode_cursor(key_value):
+    """Encodes the last key value of a page as an opaque cursor string"""
+    return base64.urlsafe_b64encode(key_value.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decodes a cursor created by encode_cursor, raising ValueError if it is malformed"""
+    try:
+        return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor: ' + cursor)
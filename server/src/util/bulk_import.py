@@ -0,0 +1,153 @@
+"""bulk_import.py - Creates users in batches from newline delimited JSON"""
+# Each input line is one user object, with the same fields as a POST /users
+# request except reCaptchaResponse. Lines are read and processed a batch at
+# a time, so memory use depends on the batch size and not on the input size.
+# For each batch:
+#   - lines that are not valid JSON or not valid users are reported invalid
+#   - usernames, emails and phones are checked against the database in one
+#     query, and against the earlier lines of the batch
+#   - the passwords of the remaining users are hashed on the hashing pool
+#   - the users and their username trigrams are inserted with bulk inserts
+#     and committed together
+# One result per input line is yielded as each batch completes.
+
+import json
+import uuid
+from jsonschema import Draft4Validator
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from dm.User import User
+from dm.UserTrigram import UserTrigram, trigram_rows
+
+# Fields with unique indexes, checked for duplicates
+UNIQUE_FIELDS = ('username', 'email', 'phone')
+
+# Matches the createUser definition of the OpenAPI spec, less reCaptchaResponse
+BULK_USER_SCHEMA = {
+    'type': 'object',
+    'required': ['username', 'email', 'phone', 'password'],
+    'properties': {
+        'username': {'type': 'string', 'minLength': 4, 'maxLength': 32},
+        'email': {'type': 'string', 'minLength': 4, 'maxLength': 80},
+        'phone': {'type': 'string', 'minLength': 10, 'maxLength': 20},
+        'first_name': {'type': 'string', 'minLength': 2, 'maxLength': 80},
+        'last_name': {'type': 'string', 'minLength': 2, 'maxLength': 80},
+        'password': {'type': 'string', 'minLength': 8, 'maxLength': 32},
+        'preferences': {'type': 'object'},
+        'roles': {'type': 'string', 'maxLength': 120}
+    }
+}
+VALIDATOR = Draft4Validator(BULK_USER_SCHEMA)
+
+def parse_line(line):
+    """Returns (user, None) for a valid user line, or (None, error text)"""
+    try:
+        user = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+    except ValueError as err:
+        return None, 'Invalid JSON: ' + str(err)
+    error = next(VALIDATOR.iter_errors(user), None)
+    if error is not None:
+        return None, error.message
+    return user, None
+
+def import_users(session, lines, batch_size, hasher):
+    """Creates users from an iterable of NDJSON lines, yielding a result per line"""
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        batch.append((number,) + parse_line(line))
+        if len(batch) >= batch_size:
+            for result in import_batch(session, batch, hasher):
+                yield result
+            batch = []
+    if batch:
+        for result in import_batch(session, batch, hasher):
+            yield result
+
+def existing_keys(session, users):
+    """Returns a set of (field, lowercase value) pairs already used by other users"""
+    values = {field: [user[field] for user in users] for field in UNIQUE_FIELDS}
+    ret = set()
+    if not users:
+        return ret
+    rows = session.query(User.username, User.email, User.phone)\
+                  .filter(or_(*[getattr(User, field).in_(values[field])
+                                for field in UNIQUE_FIELDS])).all()
+    for row in rows:
+        for field, value in zip(UNIQUE_FIELDS, row):
+            if value is not None:
+                ret.add((field, value.lower()))
+    return ret
+
+def import_batch(session, batch, hasher):
+    """Creates the users of one batch of (line number, user, error), yielding a result per line"""
+    results = {}
+    # Unique indexes use a case insensitive collation, so compare lowercase
+    taken = existing_keys(session, [user for _, user, _ in batch if user])
+    accepted = []
+    for number, user, error in batch:
+        if error:
+            results[number] = {'line': number, 'status': 'invalid', 'error': error}
+            continue
+        keys = [(field, user[field].lower()) for field in UNIQUE_FIELDS]
+        duplicate = next((field for field, value in keys if (field, value) in taken), None)
+        if duplicate:
+            results[number] = {'line': number, 'status': 'duplicate', 'field': duplicate,
+                               'username': user['username']}
+            continue
+        taken.update(keys)
+        accepted.append((number, user))
+
+    hashes = hasher.hash_many([user['password'] for _, user in accepted])
+    rows = []
+    for (number, user), password_hash in zip(accepted, hashes):
+        user_id = uuid.uuid4().bytes
+        rows.append((number, {
+            'user_id': user_id,
+            'username': user['username'],
+            'email': user['email'],
+            'phone': user['phone'],
+            'first_name': user.get('first_name'),
+            'last_name': user.get('last_name'),
+            'preferences': user.get('preferences'),
+            'roles': user.get('roles', 'User'),
+            'source': 'Local',
+            'password_hash': password_hash
+        }))
+    insert_rows(session, rows, results)
+    for number, _, _ in batch:
+        yield results[number]
+
+def insert_rows(session, rows, results):
+    """Inserts (line number, user mapping) rows in one commit, falling back to one at a time"""
+    try:
+        _insert(session, [mapping for _, mapping in rows])
+        session.commit()
+    except IntegrityError:
+        # Another request took one of the keys since the duplicate check, so
+        # find out which users still fit by inserting them one at a time
+        session.rollback()
+        for number, mapping in rows:
+            try:
+                _insert(session, [mapping])
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                results[number] = {'line': number, 'status': 'duplicate', 'field': None,
+                                   'username': mapping['username']}
+    for number, mapping in rows:
+        if number not in results:
+            results[number] = {'line': number, 'status': 'created',
+                               'user_id': str(uuid.UUID(bytes=mapping['user_id'])),
+                               'username': mapping['username']}
+
+def _insert(session, mappings):
+    """Bulk inserts user mappings and their username trigrams"""
+    # Bulk inserts do not run the mapper events that index usernames
+    postings = []
+    for mapping in mappings:
+        postings.extend(trigram_rows(mapping['user_id'], mapping['username']))
+    session.bulk_insert_mappings(User, mappings)
+    if postings:
+        session.bulk_insert_mappings(UserTrigram, postings)
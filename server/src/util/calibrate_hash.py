@@ -0,0 +1,73 @@
+"""calibrate_hash.py - Chooses password hashing rounds for a target verify latency"""
+# Run this on the host (or in the container) that will serve logins, e.g.:
+#   python3 /app/util/calibrate_hash.py --scheme sha512_crypt --target-ms 250
+# It times the scheme at its default rounds, scales the rounds toward the
+# target (linearly, or by powers of two for schemes such as bcrypt whose
+# rounds are a log2 cost), re-times, and prints the PASSWORD_SCHEMES and
+# PASSWORD_ROUNDS settings to use (see dm/password_policy.py). Verifying a hash
+# costs the same as computing it, so hashing time is what is measured.
+import argparse
+import math
+import time
+from passlib.registry import get_crypt_handler
+
+CALIBRATION_SECRET = 'calibration-password'
+
+def time_hash(handler, rounds, samples):
+    """Returns the median seconds to hash a password with the given rounds"""
+    configured = handler.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.time()
+        configured.hash(CALIBRATION_SECRET)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def next_rounds(handler, rounds, elapsed, target):
+    """Estimates the rounds that would take target seconds, given rounds took elapsed"""
+    if getattr(handler, 'rounds_cost', 'linear') == 'log2':
+        estimate = int(round(rounds + math.log(target / elapsed, 2)))
+    else:
+        estimate = int(rounds * target / elapsed)
+    return max(handler.min_rounds, min(handler.max_rounds, estimate))
+
+def calibrate(scheme, target, samples, iterations):
+    """Returns (rounds, seconds) closest to the target seconds for a scheme"""
+    handler = get_crypt_handler(scheme)
+    if 'rounds' not in handler.setting_kwds:
+        raise ValueError('Scheme ' + scheme + ' does not have configurable rounds')
+    rounds = handler.default_rounds
+    elapsed = time_hash(handler, rounds, samples)
+    best = (rounds, elapsed)
+    for _ in range(iterations):
+        rounds = next_rounds(handler, rounds, elapsed, target)
+        elapsed = time_hash(handler, rounds, samples)
+        if abs(elapsed - target) < abs(best[1] - target):
+            best = (rounds, elapsed)
+        if abs(elapsed - target) <= 0.05 * target:
+            break
+    return best
+
+def main():
+    """Runs the calibration from the command line"""
+    parser = argparse.ArgumentParser(description='Calibrate password hashing rounds')
+    parser.add_argument('--scheme', default='sha512_crypt',
+                        help='passlib scheme for new hashes (e.g. sha512_crypt, bcrypt, argon2)')
+    parser.add_argument('--deprecated', default='sha512_crypt,sha256_crypt',
+                        help='Comma separated schemes that existing hashes may use')
+    parser.add_argument('--target-ms', type=float, default=250.0,
+                        help='Target time to verify one password, in milliseconds')
+    parser.add_argument('--samples', type=int, default=5, help='Timings per measurement')
+    parser.add_argument('--iterations', type=int, default=4, help='Refinement steps')
+    args = parser.parse_args()
+
+    rounds, elapsed = calibrate(args.scheme, args.target_ms / 1000.0, args.samples, args.iterations)
+    schemes = [args.scheme] + [scheme for scheme in args.deprecated.split(',')
+                               if scheme and scheme != args.scheme]
+    print('# %s with %d rounds takes %.1f ms on this host' % (args.scheme, rounds, elapsed * 1000))
+    print('PASSWORD_SCHEMES=' + ','.join(schemes))
+    print('PASSWORD_ROUNDS=%d' % rounds)
+
+if __name__ == '__main__':
+    main()
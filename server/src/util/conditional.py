@@ -0,0 +1,42 @@
+"""conditional.py - ETags and conditional GETs for user responses"""
+# The client reloads the current user (GET /login) and users it shows (GET
+# /users/{user_id}) whenever it is refreshed, though the user has rarely
+# changed. User responses carry a strong ETag built from the user's ID and
+# row version (User.version_id, counted up on every update), and a request
+# whose If-None-Match holds the current ETag gets a 304 with no body, so the
+# user is not serialized or sent again.
+#
+# The ID is part of the ETag because GET /login returns whichever user the
+# token belongs to, so the same URL serves different users to a browser
+# that logs in as someone else.
+
+from flask import request, Response
+from util.fast_json import json_response
+from dm.User import User
+
+def user_etag(user_id, version_id):
+    """Returns the (unquoted) ETag of a user, given its text UUID and row version"""
+    return '%s.%d' % (user_id, version_id)
+
+def stored_version(session, user_id):
+    """Returns the stored row version of the user with binary UUID user_id, or None"""
+    return session.query(User.version_id).filter(User.user_id == user_id).scalar()
+
+def is_current(etag):
+    """Returns True if the request's If-None-Match header holds the ETag"""
+    return etag is not None and request.if_none_match.contains(etag)
+
+def not_modified(etag):
+    """Returns a 304 response for the ETag"""
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    return resp
+
+def user_response(user):
+    """Returns a JSON response of a user with its ETag, or a 304 if the client has it"""
+    etag = user_etag(user.get_uuid(), user.version_id)
+    if is_current(etag):
+        return not_modified(etag)
+    resp = json_response(user.dump())
+    resp.set_etag(etag)
+    return resp
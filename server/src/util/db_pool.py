@@ -0,0 +1,140 @@
+"""db_pool.py - Database connection pool settings, liveness checks and statistics"""
+# MySQL closes connections that have been idle longer than its wait_timeout,
+# so a pooled connection must be checked before it is handed to a request.
+# Checking every checkout costs a round trip per request, so a connection is
+# only pinged when it has not been used for DB_PING_INTERVAL seconds. If the
+# ping fails the pool discards the connection and checks out another one.
+# The pool is filled at startup so the first requests do not wait to connect.
+#
+# Configured by environment variables (not used for SQLite, which does not
+# pool connections the same way):
+#   DB_POOL_SIZE - Connections kept open in each server process (default 5)
+#   DB_MAX_OVERFLOW - Extra connections opened under load (default 10)
+#   DB_POOL_TIMEOUT - Seconds to wait for a connection before failing (default 30)
+#   DB_POOL_RECYCLE - Seconds after which a connection is reopened (default 3600)
+#   DB_PING_INTERVAL - Seconds a connection may be idle before it is pinged on
+#                      checkout (default 30, 0 pings on every checkout)
+#   DB_POOL_WARMUP - Connections opened at startup (default DB_POOL_SIZE)
+# In the async serving mode each process serves many requests at once, so
+# raise DB_POOL_SIZE and DB_MAX_OVERFLOW to match.
+
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from util.metrics import Histogram
+
+class TimedQueuePool(QueuePool):
+    """Queue pool that records how long each checkout waits for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.wait_time = Histogram()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            self.wait_time.observe(time.time() - start)
+
+def pool_options(connect_string):
+    """Returns the create_engine pool arguments for a connect string"""
+    if connect_string.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600))
+    }
+
+class PoolMonitor(object):
+    """Pings idle connections on checkout and counts pool events"""
+
+    def __init__(self, ping_interval=30.0):
+        self.ping_interval = ping_interval
+        self.pings = 0
+        self.ping_failures = 0
+        self.invalidations = 0
+        self._dbapi_error = Exception
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        """Adds the liveness check and event counters to an engine's pool"""
+        self._dbapi_error = engine.dialect.dbapi.Error
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record): # pylint: disable=W0613
+        """Treats a new connection as just used, so it is not pinged"""
+        connection_record.info['last_used'] = time.time()
+
+    def on_checkin(self, dbapi_connection, connection_record): # pylint: disable=W0613
+        """Records when a connection was last used"""
+        connection_record.info['last_used'] = time.time()
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception): # pylint: disable=W0613
+        """Counts connections discarded by the pool"""
+        with self._lock:
+            self.invalidations += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy): # pylint: disable=W0613
+        """Pings a connection that has been idle, making the pool replace it if it is dead"""
+        last_used = connection_record.info.get('last_used', 0)
+        if time.time() - last_used < self.ping_interval:
+            return
+        with self._lock:
+            self.pings += 1
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except self._dbapi_error:
+            with self._lock:
+                self.ping_failures += 1
+            # Tells the pool to discard this connection and try another
+            raise exc.DisconnectionError('Pooled connection failed its liveness check')
+
+    def stats(self, engine):
+        """Returns a dictionary of pool occupancy, checkout wait time and event counts"""
+        ret = {
+            'pings': self.pings,
+            'ping_failures': self.ping_failures,
+            'invalidations': self.invalidations
+        }
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            ret.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow()
+            })
+        if isinstance(pool, TimedQueuePool):
+            ret['wait'] = pool.wait_time.snapshot()
+        return ret
+
+def warm_up(engine, count=None):
+    """Opens count connections (default DB_POOL_WARMUP) and returns them to the pool"""
+    if count is None:
+        count = int(os.environ.get('DB_POOL_WARMUP', os.environ.get('DB_POOL_SIZE', 5)))
+    if isinstance(engine.pool, QueuePool):
+        count = min(count, engine.pool.size())
+    else:
+        count = min(count, 1)
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.raw_connection())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+POOL_MONITOR = PoolMonitor(float(os.environ.get('DB_PING_INTERVAL', 30)))
@@ -0,0 +1,156 @@
+"""hashing.py - Password hashing executor with admission control"""
+# Password hashes are deliberately slow to compute, so hashing them on the
+# request thread lets a burst of logins hold up every other endpoint. This
+# module runs hashing and verification on a dedicated pool of workers. The
+# thread executor is the default, and is safe in any serving mode. With the
+# process executor the work runs in parallel across cores rather than
+# contending for the GIL, but its processes must be forked before the
+# server process starts any threads: gunicorn_conf.py starts the pool as
+# each worker is forked. In the async serving mode, where forking from a
+# process gevent has patched is unsafe and pool threads would be greenlets
+# that hold up the event loop, the executor always runs on gevent's pool of
+# native threads. A bounded number of operations may wait for a
+# worker; once that many are waiting, new operations are rejected with
+# HashQueueFull, which the server turns into a 503 response so that callers
+# back off instead of piling up behind the pool.
+#
+# Configured by environment variables:
+#   HASH_EXECUTOR - 'thread' (default) or 'process'; ignored in the async serving mode
+#   HASH_WORKERS - Number of concurrent hashing workers (default CPU count)
+#   HASH_QUEUE_SIZE - Operations allowed to wait for a worker (default 4 per worker)
+#
+# Operations hash with the policy set by PASSWORD_SCHEMES and PASSWORD_ROUNDS
+# (see dm/password_policy.py).
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dm.password_policy import pwd_context
+from util.metrics import Histogram
+
+class HashQueueFull(Exception):
+    """Raised when the hashing queue is full and an operation is shed"""
+    pass
+
+# The operations are module level functions so that they can be sent to
+# worker processes
+def hash_password(password):
+    """Returns the hash of a password"""
+    return pwd_context.hash(password)
+
+def verify_password(password, password_hash):
+    """Returns True if the password matches the hash"""
+    return pwd_context.verify(password, password_hash)
+
+OPERATIONS = {
+    'hash': hash_password,
+    'verify': verify_password
+}
+
+class HashExecutor(object):
+    """Runs password hashing operations on a bounded pool of workers"""
+
+    def __init__(self, kind='thread', workers=None, queue_size=None):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 4 if queue_size is None else queue_size
+        self.latency = {name: Histogram() for name in OPERATIONS}
+        self.rejected = 0
+        self.cancelled = 0
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        """Returns the pool, creating it on first use in each process"""
+        with self._lock:
+            # A forked server process must not share its parent's pool
+            if self._executor is None or self._pid != os.getpid():
+                if self.kind == 'gevent':
+                    # gevent is only installed for the async serving mode
+                    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+                    self._executor = NativeThreadPoolExecutor(max_workers=self.workers)
+                elif self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def start(self):
+        """Creates the pool now, forking the worker processes of a process pool"""
+        executor = self._get_executor()
+        if self.kind == 'process':
+            # The pool forks all of its processes on the first submission
+            executor.submit(os.getpid).result()
+
+    def submit(self, operation, *args, **kwargs):
+        """Submits a hashing operation, returning a future for its result"""
+        # With block=True, waits for a free slot rather than raising HashQueueFull
+        if not self._slots.acquire(blocking=kwargs.get('block', False)):
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull('Password hashing queue is full')
+        start = time.time()
+        try:
+            future = self._get_executor().submit(OPERATIONS[operation], *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        def done(finished):
+            """Releases the slot and records the operation latency"""
+            self._slots.release()
+            if finished.cancelled():
+                with self._lock:
+                    self.cancelled += 1
+            else:
+                self.latency[operation].observe(time.time() - start)
+        future.add_done_callback(done)
+        return future
+
+    def hash(self, password):
+        """Returns the hash of a password, computed on the pool"""
+        return self.submit('hash', password).result()
+
+    def verify(self, password, password_hash):
+        """Returns True if the password matches the hash, checked on the pool"""
+        return self.submit('verify', password, password_hash).result()
+
+    def hash_many(self, passwords):
+        """Returns the hashes of a list of passwords, computed in parallel on the pool"""
+        # Bulk work waits for slots rather than being shed, and takes at most
+        # one slot per worker so that queue space is left for interactive
+        # requests
+        hashes = []
+        for start in range(0, len(passwords), self.workers):
+            futures = [self.submit('hash', password, block=True)
+                       for password in passwords[start:start + self.workers]]
+            hashes.extend(future.result() for future in futures)
+        return hashes
+
+    def needs_update(self, password_hash):
+        """Returns True if a hash was not made with the current hashing policy"""
+        # Only parses the hash, so it is cheap enough to run on the request thread
+        return pwd_context.needs_update(password_hash)
+
+    def shutdown(self):
+        """Shuts down the pool, waiting for running operations to finish"""
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        """Returns a dictionary of latency histograms and the counts of shed and cancelled operations"""
+        ret = {name: histogram.snapshot() for name, histogram in self.latency.items()}
+        ret['rejected'] = self.rejected
+        ret['cancelled'] = self.cancelled
+        return ret
+
+HASHER = HashExecutor('gevent' if os.environ.get('SERVER_MODE') == 'async' else
+                      os.environ.get('HASH_EXECUTOR', 'thread'),
+                      int(os.environ.get('HASH_WORKERS', 0)) or None,
+                      int(os.environ['HASH_QUEUE_SIZE']) if 'HASH_QUEUE_SIZE' in os.environ else None)
@@ -0,0 +1,122 @@
+"""identity_cache.py - Bounded in-process cache of authenticated user identities"""
+# Every authenticated request loads the User for the JWT identity. This module
+# keeps a snapshot of the column values of recently loaded users, keyed by the
+# text form of their UUID, so that most requests can rebuild the User without
+# a database round trip. Entries are evicted least recently used first when
+# the cache is full, and expire after a time to live so that changes made by
+# other server processes are picked up. Changes made through the API in this
+# process invalidate the entry for the changed user explicitly.
+#
+# Credentials are not cached: the password hash and reset code are left out
+# of the snapshot, so a rebuilt user loads them from the database when they
+# are read, and authorization reads the stored roles (has_role) rather than
+# the cached ones. A password change or a removed role made by another
+# process therefore takes effect at once rather than after the time to live.
+#
+# Configured by environment variables:
+#   USER_CACHE_SIZE - Maximum number of cached users (0 disables the cache)
+#   USER_CACHE_TTL - Seconds a cached user is trusted before it is reloaded
+
+import copy
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from dm.User import User
+
+# Columns left out of the cached snapshot of a user
+CREDENTIAL_FIELDS = ('password_hash', 'reset_code', 'reset_expires')
+
+class IdentityCache(object):
+    """Thread safe LRU cache whose entries expire after a time to live"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, expires=None):
+        """Caches value for key, evicting the least recently used entries if full"""
+        # expires, a time.time() value, ends the entry before its time to live
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            deadline = time.time() + self.ttl
+            self._entries[key] = (deadline if expires is None else min(deadline, expires), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+USER_CACHE = IdentityCache(int(os.environ.get('USER_CACHE_SIZE', 10000)),
+                           float(os.environ.get('USER_CACHE_TTL', 60)))
+
+def user_cache_key(user_id):
+    """Returns the cache key for a text UUID, in the form used by JWT identities"""
+    return str(uuid.UUID(user_id))
+
+def load_user(session, user_id):
+    """Returns the User with the text UUID user_id attached to session, or None"""
+    key = user_cache_key(user_id)
+    values = USER_CACHE.get(key)
+    if values is not None:
+        # Rebuild the user as a clean detached instance, and merge it into
+        # the session without loading it from the database. The credential
+        # columns are missing, so they are expired and loaded when read
+        user = User(**copy.deepcopy(values))
+        make_transient_to_detached(user)
+        return session.merge(user, load=False)
+    user = session.query(User).filter(User.user_id == uuid.UUID(user_id).bytes).one_or_none()
+    if user is not None:
+        USER_CACHE.put(key, copy.deepcopy({column.key: getattr(user, column.key)
+                                           for column in User.__table__.columns
+                                           if column.key not in CREDENTIAL_FIELDS}))
+    return user
+
+def has_role(session, user, role):
+    """Returns True if the stored row of user has role, for authorization decisions"""
+    roles = session.query(User.roles).filter(User.user_id == user.user_id).scalar()
+    return role in (roles or '')
+
+def invalidate_user(user_id):
+    """Removes the user with text UUID user_id from the cache after it is changed"""
+    USER_CACHE.invalidate(user_cache_key(user_id))
@@ -0,0 +1,158 @@
+"""instrumentation.py - Records request, database and component metrics"""
+# Request latency is recorded per OpenAPI operation and status code once the
+# response, including any streamed body, is finished. Every SQL statement the
+# engine runs is timed, and counted against the request that ran it, so each
+# operation reports how many queries it makes and how long it waits on them.
+# The stats of the server components (password hashing, the user and token
+# caches, the outbox, ReCaptcha, the connection pool, request session use and
+# the log queue) are turned into samples whenever a metrics snapshot is taken.
+
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from util.metrics import REGISTRY, COUNT_BUCKETS, histogram_sample
+from util.hashing import HASHER
+from util.identity_cache import USER_CACHE
+from util.jwt_cache import JWT_CACHE
+from util.revocation import REVOCATIONS
+from util.mailer import OUTBOX
+from util.recaptcha import RECAPTCHA
+from util.lazy_session import SESSION_USAGE
+from util.log_config import LOGGING
+
+# Statement kinds reported separately, the rest are counted as OTHER
+STATEMENT_KINDS = frozenset(['SELECT', 'INSERT', 'UPDATE', 'DELETE'])
+
+REGISTRY.describe('olsnet_request_seconds', 'Request latency by operation and status code')
+REGISTRY.describe('olsnet_request_sql_queries', 'SQL statements run per request by operation')
+REGISTRY.describe('olsnet_request_sql_seconds', 'Time per request spent in SQL by operation')
+REGISTRY.describe('olsnet_sql_seconds', 'SQL statement latency by statement kind')
+REGISTRY.describe('olsnet_external_call_seconds', 'Latency of calls to external services')
+REGISTRY.describe('olsnet_password_hash_seconds', 'Password hashing latency by operation')
+REGISTRY.describe('olsnet_token_refreshes_total',
+                  'Authenticated responses that re-issued or kept the access token')
+
+def operation_name():
+    """Returns the OpenAPI operation, or else the Flask endpoint, serving the request"""
+    rule = request.url_rule
+    if rule is None:
+        return 'unmatched'
+    # Connexion names endpoints <base path>.<operationId with _ for .>
+    return rule.endpoint.rsplit('.', 1)[-1]
+
+def start_request():
+    """Starts timing the request and counting its SQL statements"""
+    g.request_start = time.time()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+def record_response(resp):
+    """Remembers the response status for finish_request"""
+    g.response_status = resp.status_code
+
+def request_status(err):
+    """Returns the status code of the finished request"""
+    return 500 if err is not None else g.get('response_status', 500)
+
+def finish_request(err):
+    """Records the request latency and SQL use, once the response is done"""
+    if 'request_start' not in g:
+        return
+    status = request_status(err)
+    operation = operation_name()
+    REGISTRY.observe('olsnet_request_seconds', time.time() - g.request_start,
+                     {'operation': operation, 'status': str(status)})
+    REGISTRY.observe('olsnet_request_sql_queries', g.sql_queries,
+                     {'operation': operation}, COUNT_BUCKETS)
+    REGISTRY.observe('olsnet_request_sql_seconds', g.sql_seconds, {'operation': operation})
+
+def statement_kind(statement):
+    """Returns SELECT, INSERT, UPDATE, DELETE or OTHER for a SQL statement"""
+    words = statement.split(None, 1)
+    kind = words[0].upper() if words else ''
+    return kind if kind in STATEMENT_KINDS else 'OTHER'
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=R0913,W0613
+    conn.info.setdefault('query_start', []).append(time.time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=R0913,W0613
+    elapsed = time.time() - conn.info['query_start'].pop()
+    REGISTRY.observe('olsnet_sql_seconds', elapsed, {'statement': statement_kind(statement)})
+    # Statements from background threads, such as the outbox sender, are
+    # not part of a request
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+        if 'profile' in g:
+            g.profile.record_sql(statement, elapsed)
+
+def _handle_error(context):
+    """Drops the start time of a statement that failed"""
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+def instrument_engine(engine):
+    """Times the SQL statements run by an engine, returning the engine"""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    return engine
+
+def component_collector(pool_stats):
+    """Returns a collector of component stats, getting the pool stats from pool_stats()"""
+    def collect():
+        """Returns samples of the current component stats"""
+        hashing = HASHER.stats()
+        cache = USER_CACHE.stats()
+        tokens = JWT_CACHE.stats()
+        revoked = REVOCATIONS.stats()
+        outbox = OUTBOX.stats()
+        recaptcha = RECAPTCHA.stats()
+        sessions = SESSION_USAGE.stats()
+        samples = [
+            ('histogram', 'olsnet_password_hash_seconds', {'operation': 'hash'},
+             histogram_sample(hashing['hash'])),
+            ('histogram', 'olsnet_password_hash_seconds', {'operation': 'verify'},
+             histogram_sample(hashing['verify'])),
+            ('counter', 'olsnet_password_hash_rejected_total', {}, hashing['rejected']),
+            ('counter', 'olsnet_password_hash_cancelled_total', {}, hashing['cancelled']),
+            ('gauge', 'olsnet_user_cache_entries', {}, cache['size']),
+            ('counter', 'olsnet_user_cache_hits_total', {}, cache['hits']),
+            ('counter', 'olsnet_user_cache_misses_total', {}, cache['misses']),
+            ('counter', 'olsnet_user_cache_evictions_total', {}, cache['evictions']),
+            ('gauge', 'olsnet_jwt_cache_entries', {}, tokens['size']),
+            ('counter', 'olsnet_jwt_cache_hits_total', {}, tokens['hits']),
+            ('counter', 'olsnet_jwt_cache_misses_total', {}, tokens['misses']),
+            ('counter', 'olsnet_revocation_checks_total', {}, revoked['checks']),
+            ('counter', 'olsnet_revocation_lookups_total', {}, revoked['lookups']),
+            ('counter', 'olsnet_revocation_false_positives_total', {},
+             revoked['false_positives']),
+            ('counter', 'olsnet_tokens_revoked_total', {}, revoked['revoked']),
+            ('gauge', 'olsnet_revocation_filter_entries', {}, revoked['filter_entries']),
+            ('histogram', 'olsnet_external_call_seconds', {'service': 'smtp'},
+             histogram_sample(outbox['latency'])),
+            ('counter', 'olsnet_outbox_sent_total', {}, outbox['sent']),
+            ('counter', 'olsnet_outbox_failed_total', {}, outbox['failed']),
+            ('counter', 'olsnet_outbox_purged_total', {}, outbox['purged']),
+            ('histogram', 'olsnet_external_call_seconds', {'service': 'recaptcha'},
+             histogram_sample(recaptcha['latency'])),
+            ('counter', 'olsnet_recaptcha_errors_total', {}, recaptcha['errors']),
+            ('counter', 'olsnet_recaptcha_short_circuits_total', {}, recaptcha['short_circuits']),
+            # Added up across processes, this is the number with an open breaker
+            ('gauge', 'olsnet_recaptcha_breaker_open', {},
+             1 if recaptcha['breaker'] == 'open' else 0),
+            ('counter', 'olsnet_requests_total', {}, sessions['requests']),
+            ('counter', 'olsnet_requests_used_database_total', {}, sessions['used']),
+            ('counter', 'olsnet_log_records_dropped_total', {}, LOGGING.stats()['dropped'])
+        ]
+        pool = pool_stats()
+        for name in ('pings', 'ping_failures', 'invalidations'):
+            samples.append(('counter', 'olsnet_db_pool_' + name + '_total', {}, pool[name]))
+        for name in ('size', 'checked_in', 'checked_out', 'overflow'):
+            if name in pool:
+                samples.append(('gauge', 'olsnet_db_pool_' + name, {}, pool[name]))
+        if 'wait' in pool:
+            samples.append(('histogram', 'olsnet_db_pool_wait_seconds', {},
+                            histogram_sample(pool['wait'])))
+        return samples
+    return collect
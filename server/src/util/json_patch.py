@@ -0,0 +1,77 @@
+"""json_patch.py - JSON merge patches, applied in Python or in the database"""
+# A merge patch (RFC 7396) is a JSON object of the members to change: each
+# member replaces the target's member of the same name, except that null
+# removes the member, and an object is itself merged into the target's
+# object member.
+#
+# Changing a few top level members of a JSON column, such as one user
+# preference, would otherwise read the whole document, merge it and write it
+# back. json_update() instead builds a single UPDATE expression with the
+# database's JSON functions, for the dialects in JSON_FUNCTIONS. Patches that
+# merge nested objects cannot be expressed that way, and are left to
+# merge_patch().
+
+import re
+from sqlalchemy import func, literal, or_
+from util.fast_json import dumps
+
+# Member names that can be written in a JSON path without escaping
+SIMPLE_MEMBER = re.compile(r'^[^"\\\x00-\x1f]+$')
+
+class JSONFunctions(object):
+    """SQL functions a dialect uses to change the members of a JSON object column"""
+
+    def __init__(self, set_members, remove_members, parse, json_type, object_type, empty):
+        self.set_members = set_members
+        self.remove_members = remove_members
+        self.parse = parse
+        self.json_type = json_type
+        self.object_type = object_type
+        self.empty = empty
+
+JSON_FUNCTIONS = {
+    'mysql': JSONFunctions(func.JSON_SET, func.JSON_REMOVE,
+                           lambda text: func.JSON_EXTRACT(text, '$'), func.JSON_TYPE, 'OBJECT',
+                           func.JSON_OBJECT),
+    'sqlite': JSONFunctions(func.json_set, func.json_remove, func.json, func.json_type, 'object',
+                            lambda: literal('{}'))
+}
+
+def merge_patch(target, patch):
+    """Returns target with a merge patch applied, leaving target unchanged"""
+    if not isinstance(patch, dict):
+        return patch
+    ret = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            ret.pop(key, None)
+        else:
+            ret[key] = merge_patch(ret.get(key), value)
+    return ret
+
+def json_update(dialect_name, column, patch):
+    """Returns (SQL expression, row condition) applying a merge patch to a JSON column, or None"""
+    functions = JSON_FUNCTIONS.get(dialect_name)
+    if functions is None or not isinstance(patch, dict) or not patch or\
+       any(isinstance(value, dict) or not SIMPLE_MEMBER.match(key)
+           for key, value in patch.items()):
+        return None
+    assignments = []
+    removals = []
+    for key, value in patch.items():
+        path = '$."%s"' % key
+        if value is None:
+            removals.append(path)
+        else:
+            # Values are passed as JSON text and parsed, so that true stays
+            # a boolean rather than becoming 1
+            assignments.extend([path, functions.parse(dumps(value).decode('utf-8'))])
+    expression = func.coalesce(column, functions.empty())
+    if assignments:
+        expression = functions.set_members(expression, *assignments)
+    if removals:
+        expression = functions.remove_members(expression, *removals)
+    # A document that is not an object is replaced by the patch, which
+    # needs the merge in Python
+    condition = or_(column.is_(None), functions.json_type(column) == functions.object_type)
+    return expression, condition
@@ -0,0 +1,43 @@
+"""jwt_cache.py - Cache of verified JWTs"""
+# flask_jwt_extended decodes the JWT cookie, checking its signature and
+# claims, on every authenticated request, though a client sends the same
+# access token for up to 15 minutes. This module keeps the claims of
+# recently verified tokens, keyed on a SHA-256 digest of the encoded token
+# and the key and algorithm it was verified with, in an LRU cache whose
+# entries expire no later than the token's exp claim. Only the signature
+# check and claim parsing are skipped on a hit: the library still checks the
+# token type and the CSRF double submit header, and util/revocation.py checks
+# whether the token was revoked, on every request, so a revoked token is
+# rejected even while its claims are cached.
+#
+# flask_jwt_extended has no hook for decoding, so install() replaces the
+# decode function its view decorators use.
+#
+# Configured by environment variables:
+#   JWT_CACHE_SIZE - Maximum number of cached tokens (0 disables the cache)
+#   JWT_CACHE_TTL - Longest time a token's claims are cached, in seconds
+
+import hashlib
+import os
+from flask_jwt_extended import view_decorators
+from flask_jwt_extended.tokens import decode_jwt
+from util.identity_cache import IdentityCache
+
+JWT_CACHE = IdentityCache(int(os.environ.get('JWT_CACHE_SIZE', 10000)),
+                          float(os.environ.get('JWT_CACHE_TTL', 900)))
+
+def cached_decode_jwt(encoded_token, secret, algorithm, csrf):
+    """Returns the claims of a JWT, verifying it only if it is not cached"""
+    key = hashlib.sha256('\n'.join([secret, algorithm, str(csrf), encoded_token])
+                         .encode('utf-8')).digest()
+    data = JWT_CACHE.get(key)
+    if data is None:
+        # Raises for invalid and expired tokens, which are never cached
+        data = decode_jwt(encoded_token, secret, algorithm, csrf)
+        JWT_CACHE.put(key, data, data['exp'])
+    return dict(data)
+
+def install():
+    """Makes flask_jwt_extended's view decorators use the cache, if it is enabled"""
+    if JWT_CACHE.max_size > 0:
+        view_decorators.decode_jwt = cached_decode_jwt
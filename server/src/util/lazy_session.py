@@ -0,0 +1,74 @@
+"""lazy_session.py - Request database session that is only created when used"""
+# Every request gets g.db_session, but many requests never touch the
+# database: logout, requests rejected before they reach a handler, and
+# requests whose user comes from the identity cache. LazySession stands in
+# for the session and only creates the real one when an attribute of it is
+# first used, and closing a session that was never created does nothing.
+#
+# Creating a session does not by itself check out a connection; that happens
+# when the session begins its first transaction. Sessions from a factory
+# passed to track_connection_use mark themselves when that happens, so each
+# request records whether it used a database connection.
+
+import threading
+from sqlalchemy import event
+
+class LazySession(object):
+    """Proxy for a database session that creates the session on first use"""
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._session = None
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the proxy itself
+        if self._session is None:
+            self._session = self._session_factory()
+        return getattr(self._session, name)
+
+    @property
+    def created(self):
+        """True if the real session has been created"""
+        return self._session is not None
+
+    @property
+    def used(self):
+        """True if the session has checked out a database connection"""
+        return self._session is not None and self._session.info.get('used_connection', False)
+
+    def close(self):
+        """Closes the session if it was created"""
+        if self._session is not None:
+            self._session.close()
+
+def _mark_connection_used(session, transaction, connection): # pylint: disable=W0613
+    """Records on the session that it began a transaction on a connection"""
+    session.info['used_connection'] = True
+
+def track_connection_use(session_factory):
+    """Makes sessions from session_factory record when they check out a connection"""
+    event.listen(session_factory, 'after_begin', _mark_connection_used)
+    return session_factory
+
+class SessionUsage(object):
+    """Counts requests and how many of them used a database connection"""
+
+    def __init__(self):
+        self.requests = 0
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def record(self, session):
+        """Records whether a request's LazySession used the database"""
+        with self._lock:
+            self.requests += 1
+            if session.used:
+                self.used += 1
+
+    def stats(self):
+        """Returns a dictionary of request counts with and without database use"""
+        with self._lock:
+            return {'requests': self.requests, 'used': self.used,
+                    'unused': self.requests - self.used}
+
+SESSION_USAGE = SessionUsage()
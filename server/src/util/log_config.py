@@ -0,0 +1,186 @@
+"""log_config.py - Non-blocking, structured logging for the server"""
+# Log calls on request threads never wait on log output. The root logger has
+# a single QueueHandler, which only fills in the record's message (and the
+# text of any exception) before putting it on a bounded queue. A
+# QueueListener thread takes records off the queue, formats them and writes
+# them to stderr. When the queue is full new records are dropped and
+# counted rather than blocking the request.
+#
+# Records are written as one JSON object per line, with the time, level,
+# logger, message, process, thread and (when logged during a request) the
+# request method and path. Log calls should pass their values as arguments
+# (LOGGER.debug('Deleting user %s', user_id)), so that nothing is formatted
+# for records below the configured level.
+#
+# Configured by environment variables:
+#   LOG_LEVEL - Level of the root logger (default INFO)
+#   LOG_LEVELS - Levels of individual loggers, for example
+#                api.users=DEBUG,sqlalchemy.engine=INFO
+#   LOG_SAMPLE - Fraction of records below WARNING to keep per logger, for
+#                example api.login=0.1 keeps one in ten of the login logs
+#   LOG_FORMAT - 'json' (default) or 'text'
+#   LOG_QUEUE_SIZE - Records waiting to be written before more are dropped
+#                    (default 10000)
+
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from flask import has_request_context, request
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+def parse_settings(text):
+    """Returns a dictionary from a comma separated list of name=value settings"""
+    ret = {}
+    for setting in (text or '').split(','):
+        if '=' in setting:
+            name, value = setting.split('=', 1)
+            ret[name.strip()] = value.strip()
+    return ret
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+
+    def format(self, record):
+        ret = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName
+        }
+        if getattr(record, 'request_path', None):
+            ret['method'] = record.request_method
+            ret['path'] = record.request_path
+        if record.exc_text:
+            ret['exception'] = record.exc_text
+        return json.dumps(ret, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records below WARNING from chosen loggers"""
+
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates
+        self._cache = {}
+
+    def rate(self, name):
+        """Returns the keep rate of a logger, inherited from its closest configured parent"""
+        if name not in self._cache:
+            rate = 1.0
+            parts = name.split('.')
+            for end in range(len(parts), 0, -1):
+                prefix = '.'.join(parts[:end])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._cache[name] = rate
+        return self._cache[name]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when its queue is full instead of waiting"""
+
+    def __init__(self, log_queue):
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Only what cannot wait for the listener thread is done here: the
+        # arguments and traceback may change or be freed once the log call
+        # returns, and the request is only known on the request thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.request_method = request.method
+            record.request_path = request.path
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline(object):
+    """Routes all logging through a queue to a writer thread"""
+
+    def __init__(self, level='INFO', levels=None, sample=None, log_format='json',
+                 queue_size=10000, stream=None):
+        self.level = level
+        self.levels = levels or {}
+        self.sample = sample or {}
+        self.log_format = log_format
+        self.queue_size = queue_size
+        self.stream = stream or sys.stderr
+        self.handler = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Replaces the root logger's handlers with the queue, and starts the writer thread"""
+        with self._lock:
+            if self._listener is not None:
+                return
+            output = logging.StreamHandler(self.stream)
+            if self.log_format == 'text':
+                output.setFormatter(logging.Formatter(TEXT_FORMAT))
+            else:
+                output.setFormatter(JSONFormatter())
+            self.handler = NonBlockingQueueHandler(queue.Queue(self.queue_size))
+            if self.sample:
+                self.handler.addFilter(SamplingFilter(self.sample))
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(self.handler)
+            root.setLevel(self.level)
+            for name, level in self.levels.items():
+                logging.getLogger(name).setLevel(level)
+            self._listener = logging.handlers.QueueListener(self.handler.queue, output)
+            self._listener.start()
+
+    def adopt(self, logger):
+        """Sends a logger that has its own handlers, such as a Flask app's, through the queue"""
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = True
+        if logger.name not in self.levels:
+            logger.setLevel(logging.NOTSET)
+
+    def stop(self):
+        """Writes out the queued records and stops the writer thread"""
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def stats(self):
+        """Returns a dictionary with the number of records dropped on a full queue"""
+        return {'dropped': self.handler.dropped if self.handler else 0}
+
+LOGGING = LogPipeline(os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                      {name: level.upper()
+                       for name, level in parse_settings(os.environ.get('LOG_LEVELS')).items()},
+                      {name: float(rate)
+                       for name, rate in parse_settings(os.environ.get('LOG_SAMPLE')).items()},
+                      os.environ.get('LOG_FORMAT', 'json'),
+                      int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
@@ -0,0 +1,245 @@
+"""mailer.py - Background sender that delivers queued emails from the outbox"""
+# Request handlers queue emails as OutboxMessage rows (see dm/Outbox.py) in
+# the same transaction as the change they are about, so a request never waits
+# on DNS, the SMTP handshake or delivery. The sender thread in each server
+# process drains the outbox in batches over a single SMTP connection that is
+# reused between batches; the connection is only checked with a NOOP before
+# it is used again after being idle, as a dropped connection also shows up
+# as a failed delivery, which is retried. Failed deliveries are retried with
+# exponential backoff until OUTBOX_MAX_ATTEMPTS is reached. Sent messages are
+# deleted once they are OUTBOX_RETENTION_DAYS old, checked every
+# PURGE_INTERVAL_SECONDS, so the outbox does not grow without bound.
+#
+# Several server processes may drain the same outbox. Each message is claimed
+# before it is sent by moving its next_attempt forward with a conditional
+# UPDATE, so only the process whose UPDATE matched will send it.
+#
+# Configured by environment variables:
+#   SMTP_HOST, SMTP_PORT - Mail relay (default mail.ourlifestories.net:25). For
+#       local testing point these at an SMTP stand-in such as
+#       python3 -m aiosmtpd -n -l localhost:8025
+#   OUTBOX_ENABLED - Set to 0 to not run the sender in this process
+#   OUTBOX_BATCH_SIZE - Messages claimed per batch (default 50)
+#   OUTBOX_POLL_INTERVAL - Seconds between checks of an empty outbox (default 5)
+#   OUTBOX_MAX_ATTEMPTS - Delivery attempts before a message fails (default 8)
+#   OUTBOX_BACKOFF - Seconds before the first retry, doubled per attempt (default 30)
+#   OUTBOX_RETENTION_DAYS - Days sent messages are kept (default 7)
+
+import datetime
+import logging
+import os
+import smtplib
+import threading
+import time
+from sqlalchemy import and_
+from dm.Outbox import OutboxMessage
+from util.metrics import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+# Longest wait between retries, and how long a claimed message is reserved
+# for the process that claimed it before another process may retry it
+MAX_BACKOFF_SECONDS = 3600
+CLAIM_LEASE_SECONDS = 300
+# Close the SMTP connection after it has been idle this long, and check it
+# is still open before using it after it has been idle for the shorter time
+SMTP_IDLE_SECONDS = 60
+SMTP_CHECK_SECONDS = 10
+# Seconds between purges of old sent messages, and messages deleted per statement
+PURGE_INTERVAL_SECONDS = 3600
+PURGE_BATCH_SIZE = 1000
+
+class OutboxSender(object):
+    """Drains the email outbox on a background thread"""
+
+    def __init__(self, host, port, batch_size=50, poll_interval=5.0,
+                 max_attempts=8, backoff=30.0, enabled=True, retention_days=7.0):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.enabled = enabled
+        self.retention_days = retention_days
+        self.sent = 0
+        self.failed = 0
+        self.purged = 0
+        self._next_purge = 0.0
+        self.latency = Histogram()
+        self._session_factory = None
+        self._smtp = None
+        self._smtp_used = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, session_factory):
+        """Starts the sender thread, using session_factory for database sessions"""
+        self._session_factory = session_factory
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name='outbox-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stops the sender thread after its current batch"""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Tells the sender that new messages are waiting"""
+        self._wake.set()
+
+    def run(self):
+        """Sender thread main loop"""
+        while not self._stopping.is_set():
+            try:
+                processed = self.drain_once()
+            except Exception: # pylint: disable=W0703
+                LOGGER.exception('Outbox sender failed to drain the outbox')
+                processed = 0
+            if time.time() >= self._next_purge:
+                self._next_purge = time.time() + PURGE_INTERVAL_SECONDS
+                try:
+                    self.purge()
+                except Exception: # pylint: disable=W0703
+                    LOGGER.exception('Outbox sender failed to purge sent messages')
+            if processed < self.batch_size:
+                self._close_idle_connection()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        self._close_connection()
+
+    def drain_once(self):
+        """Claims and sends one batch of due messages, returning how many were processed"""
+        session = self._session_factory()
+        try:
+            messages = self._claim_batch(session)
+            for message in messages:
+                self._deliver(message)
+            session.commit()
+            return len(messages)
+        finally:
+            session.close()
+
+    def purge(self):
+        """Deletes sent messages older than the retention period, returning how many"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+        session = self._session_factory()
+        purged = 0
+        try:
+            # Deleted a batch at a time, so no statement holds locks for long
+            while True:
+                message_ids = [message_id for message_id, in
+                               session.query(OutboxMessage.message_id)
+                               .filter(and_(OutboxMessage.status == 'sent',
+                                            OutboxMessage.sent < cutoff))
+                               .limit(PURGE_BATCH_SIZE)]
+                if not message_ids:
+                    break
+                purged += session.query(OutboxMessage)\
+                                 .filter(OutboxMessage.message_id.in_(message_ids))\
+                                 .delete(synchronize_session=False)
+                session.commit()
+        finally:
+            session.close()
+        self.purged += purged
+        return purged
+
+    def _claim_batch(self, session):
+        """Returns the due messages this process managed to claim"""
+        now = datetime.datetime.now()
+        candidates = session.query(OutboxMessage.message_id, OutboxMessage.next_attempt)\
+                            .filter(and_(OutboxMessage.status == 'pending',
+                                         OutboxMessage.next_attempt <= now))\
+                            .order_by(OutboxMessage.next_attempt)\
+                            .limit(self.batch_size).all()
+        lease = now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS)
+        claimed = []
+        for message_id, next_attempt in candidates:
+            count = session.query(OutboxMessage)\
+                           .filter(and_(OutboxMessage.message_id == message_id,
+                                        OutboxMessage.status == 'pending',
+                                        OutboxMessage.next_attempt == next_attempt))\
+                           .update({'next_attempt': lease}, synchronize_session=False)
+            if count == 1:
+                claimed.append(message_id)
+        session.commit()
+        if not claimed:
+            return []
+        return session.query(OutboxMessage).filter(OutboxMessage.message_id.in_(claimed)).all()
+
+    def _deliver(self, message):
+        """Sends one message, recording success or scheduling a retry"""
+        try:
+            msg = message.as_mime()
+            start = time.time()
+            try:
+                self._connection().sendmail(message.sender, [message.recipient], msg.as_string())
+            finally:
+                self.latency.observe(time.time() - start)
+            self._smtp_used = time.time()
+            message.status = 'sent'
+            message.sent = datetime.datetime.now()
+            self.sent += 1
+        except (smtplib.SMTPException, OSError) as err:
+            # Drop the connection so the next message starts with a fresh one
+            self._close_connection()
+            message.attempts = (message.attempts or 0) + 1
+            message.last_error = str(err)[:500]
+            if message.attempts >= self.max_attempts:
+                message.status = 'failed'
+                self.failed += 1
+                LOGGER.error('Giving up on outbox message %s to %s: %s',
+                             message.message_id, message.recipient, err)
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff * 2 ** (message.attempts - 1))
+                message.next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+                LOGGER.warning('Outbox message %s to %s failed, retrying in %s seconds: %s',
+                               message.message_id, message.recipient, delay, err)
+
+    def _connection(self):
+        """Returns the open SMTP connection, reconnecting if the server dropped it"""
+        # A connection in steady use is not checked before every message
+        if self._smtp is not None and time.time() - self._smtp_used > SMTP_CHECK_SECONDS:
+            try:
+                self._smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                self._close_connection()
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self.host, self.port)
+        return self._smtp
+
+    def _close_idle_connection(self):
+        """Closes the SMTP connection if it has not been used recently"""
+        if self._smtp is not None and time.time() - self._smtp_used > SMTP_IDLE_SECONDS:
+            self._close_connection()
+
+    def _close_connection(self):
+        """Closes the SMTP connection, ignoring errors from a dead connection"""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def stats(self):
+        """Returns a dictionary of delivery counters and SMTP latency for this process"""
+        return {'sent': self.sent, 'failed': self.failed, 'purged': self.purged,
+                'latency': self.latency.snapshot()}
+
+OUTBOX = OutboxSender(os.environ.get('SMTP_HOST', 'mail.ourlifestories.net'),
+                      int(os.environ.get('SMTP_PORT', 25)),
+                      int(os.environ.get('OUTBOX_BATCH_SIZE', 50)),
+                      float(os.environ.get('OUTBOX_POLL_INTERVAL', 5)),
+                      int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8)),
+                      float(os.environ.get('OUTBOX_BACKOFF', 30)),
+                      os.environ.get('OUTBOX_ENABLED', '1') != '0',
+                      float(os.environ.get('OUTBOX_RETENTION_DAYS', 7)))
@@ -0,0 +1,271 @@
+"""metrics.py - Lightweight in-process metrics for server components"""
+# The intent of this module is to give components a cheap, thread safe way to
+# record how long their operations take, so that hot paths can report latency
+# distributions rather than just averages.
+#
+# REGISTRY holds labelled counters and histograms for this process, and
+# collectors that turn component stats() into samples when a snapshot is
+# taken. Each gunicorn worker has its own registry, so EXPORTER writes this
+# process's snapshot to a file in METRICS_DIR every METRICS_INTERVAL seconds.
+# Whichever worker serves /metrics adds up the fresh snapshots of all of the
+# workers and renders them in the Prometheus text format. Without METRICS_DIR
+# only this process's metrics are reported.
+#
+# Configured by environment variables:
+#   METRICS_DIR - Directory shared by the worker processes for snapshots
+#   METRICS_INTERVAL - Seconds between snapshot writes (default 5)
+# A snapshot not rewritten for STALE_INTERVALS intervals belongs to a worker
+# that has gone away and is removed. Counters from workers that exit drop out
+# of the totals, which Prometheus treats as a counter reset.
+
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Default histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bucket upper bounds for small counts, such as queries per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+STALE_INTERVALS = 6
+SNAPSHOT_PREFIX = 'metrics-'
+
+class Histogram(object):
+    """Thread safe histogram of observed values with cumulative style buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records one observed value"""
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Returns a dictionary with the count, sum and per bucket counts"""
+        with self._lock:
+            return {
+                'count': self._count,
+                'sum': self._sum,
+                'buckets': list(zip(self.buckets + (float('inf'),), self._counts))
+            }
+
+def _label_key(labels):
+    """Returns a hashable, ordered form of a labels dictionary"""
+    return tuple(sorted(labels.items())) if labels else ()
+
+class MetricsRegistry(object):
+    """Labelled counters and histograms for this process, plus component collectors"""
+
+    def __init__(self):
+        self.help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        """Sets the help text reported for a metric"""
+        self.help[name] = text
+
+    def inc(self, name, labels=None, amount=1):
+        """Adds amount to a counter"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def histogram(self, name, labels=None, buckets=LATENCY_BUCKETS):
+        """Returns the histogram for a name and labels, creating it on first use"""
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        """Records one observed value in a histogram"""
+        self.histogram(name, labels, buckets).observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Context manager that records how long its block takes in a histogram"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def add_collector(self, collect):
+        """Adds a function returning (kind, name, labels, value) samples for each snapshot"""
+        self._collectors.append(collect)
+
+    def snapshot(self):
+        """Returns this process's samples as a JSON serializable list"""
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = list(self._histograms.items())
+        samples = [['counter', name, dict(labels), value] for (name, labels), value in counters]
+        samples.extend(['histogram', name, dict(labels), histogram_sample(histogram.snapshot())]
+                       for (name, labels), histogram in histograms)
+        for collect in self._collectors:
+            samples.extend(list(sample) for sample in collect())
+        return samples
+
+def histogram_sample(snapshot):
+    """Returns a Histogram snapshot as a sample value, with JSON safe bucket bounds"""
+    # The last bucket's infinite bound is written as None
+    return {'count': snapshot['count'], 'sum': snapshot['sum'],
+            'buckets': [[bound if bound != float('inf') else None, count]
+                        for bound, count in snapshot['buckets']]}
+
+def merge(snapshots):
+    """Combines the samples of several processes, adding values with the same name and labels"""
+    merged = OrderedDict()
+    for samples in snapshots:
+        for kind, name, labels, value in samples:
+            key = (kind, name, _label_key(labels))
+            if key not in merged:
+                merged[key] = copy.deepcopy(value)
+            elif kind == 'histogram':
+                total = merged[key]
+                total['count'] += value['count']
+                total['sum'] += value['sum']
+                for bucket, (_, count) in zip(total['buckets'], value['buckets']):
+                    bucket[1] += count
+            else:
+                merged[key] += value
+    return [[kind, name, dict(labels), value] for (kind, name, labels), value in merged.items()]
+
+def _format_labels(labels, extra=None):
+    """Returns labels in the Prometheus text format, such as {a="1",b="2"}"""
+    pairs = sorted(labels.items()) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                      .replace('"', '\\"')
+                                                      .replace('\n', '\\n'))
+                          for key, value in pairs) + '}'
+
+def render(samples, help_text=None):
+    """Returns samples in the Prometheus text exposition format"""
+    help_text = help_text or {}
+    families = OrderedDict()
+    for kind, name, labels, value in sorted(samples, key=lambda sample: sample[1]):
+        families.setdefault((name, kind), []).append((labels, value))
+    lines = []
+    for (name, kind), family in families.items():
+        if name in help_text:
+            lines.append('# HELP %s %s' % (name, help_text[name]))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in family:
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in value['buckets']:
+                cumulative += count
+                limit = '+Inf' if bound is None else repr(float(bound))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', limit)]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), value['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+class MetricsExporter(object):
+    """Shares a registry's snapshots between worker processes and renders the totals"""
+
+    def __init__(self, registry, directory=None, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _path(self, pid=None):
+        """Returns the snapshot file of a process"""
+        return os.path.join(self.directory, '%s%d.json' % (SNAPSHOT_PREFIX, pid or os.getpid()))
+
+    def start(self):
+        """Starts writing this process's snapshots in the background"""
+        if not self.directory or (self._thread and self._thread.is_alive()):
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name='metrics-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops writing snapshots and removes this process's snapshot"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(self.interval)
+            self._thread = None
+        if self.directory:
+            try:
+                os.remove(self._path())
+            except OSError:
+                pass
+
+    def run(self):
+        """Exporter thread main loop"""
+        while not self._stopping.is_set():
+            self.publish()
+            self._stopping.wait(self.interval)
+
+    def publish(self, samples=None):
+        """Writes this process's snapshot, replacing the previous one atomically"""
+        samples = self.registry.snapshot() if samples is None else samples
+        temp_path = self._path() + '.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(samples, snapshot_file)
+        os.replace(temp_path, self._path())
+
+    def collect(self):
+        """Returns the samples of every live process, added together"""
+        samples = merge([self.registry.snapshot()])
+        if not self.directory:
+            return samples
+        self.publish(samples)
+        snapshots = [samples]
+        oldest = time.time() - self.interval * STALE_INTERVALS
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith(SNAPSHOT_PREFIX) or not name.endswith('.json') or\
+               path == self._path():
+                continue
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+                    continue
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                # Removed or replaced by its process while being read
+                continue
+        return merge(snapshots)
+
+    def render(self):
+        """Returns the metrics of every live process in the Prometheus text format"""
+        return render(self.collect(), self.registry.help)
+
+REGISTRY = MetricsRegistry()
+EXPORTER = MetricsExporter(REGISTRY, os.environ.get('METRICS_DIR'),
+                           float(os.environ.get('METRICS_INTERVAL', 5)))
@@ -0,0 +1,34 @@
+"""name_search.py - Query planner for username substring searches"""
+# A username substring search is planned in two steps. First the trigram
+# postings for every trigram of the search text are intersected in the
+# UserTrigram table, which narrows the search to users whose names contain
+# all of those trigrams using only index lookups. The candidates are then
+# confirmed with the original LIKE filter, since having all of the trigrams
+# does not guarantee that they appear in order. Search text shorter than a
+# trigram has no postings to intersect, so it falls back to the LIKE scan.
+
+from sqlalchemy import func
+from dm.User import User
+from dm.UserTrigram import UserTrigram, trigrams
+
+# Escape character for LIKE patterns built from user supplied text
+LIKE_ESCAPE = '\\'
+
+def like_pattern(search_text):
+    """Returns a LIKE pattern matching search_text anywhere, with wildcards escaped"""
+    escaped = search_text.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2)\
+                         .replace('%', LIKE_ESCAPE + '%')\
+                         .replace('_', LIKE_ESCAPE + '_')
+    return '%' + escaped + '%'
+
+def filter_username_contains(query, search_text):
+    """Filters a query on User to users whose username contains search_text"""
+    search_trigrams = trigrams(search_text)
+    if search_trigrams:
+        candidates = query.session.query(UserTrigram.user_id)\
+                          .filter(UserTrigram.trigram.in_(search_trigrams))\
+                          .group_by(UserTrigram.user_id)\
+                          .having(func.count(UserTrigram.trigram) == len(search_trigrams))\
+                          .subquery()
+        query = query.join(candidates, candidates.c.user_id == User.user_id)
+    return query.filter(User.username.like(like_pattern(search_text), escape=LIKE_ESCAPE))
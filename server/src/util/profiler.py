@@ -0,0 +1,241 @@
+"""profiler.py - Opt-in profiling of individual requests"""
+# A request is profiled when it is picked by the sample rate, or when it
+# carries the PROFILE_HEADER header set to PROFILE_KEY, which only admins
+# know. With the sample rate at 0 and no header, the only cost per request
+# is the check in start().
+#
+# There are two profilers, chosen by PROFILE_MODE:
+#   cprofile (default) - Deterministic, every call on the request thread is
+#       timed. Exact, but slows the profiled request down noticeably.
+#   sample - A background thread records the request thread's stack every
+#       PROFILE_SAMPLE_INTERVAL seconds, giving folded stacks as used by
+#       flame graph tools. Cheap enough to sample requests in production.
+# Each finished profile is stored with the request's route, status, timing
+# and SQL statements in a ring buffer of the last PROFILE_BUFFER_SIZE
+# profiles, from which admins download them (see api/profiles.py). Profiles
+# are kept per process, and the sample rate can be changed at runtime per
+# process, so with several workers use the header to profile a request of
+# interest and download it from the X-Profile-Id the response carries.
+# In the async serving mode requests share a thread as greenlets, so a
+# profile also covers whatever other requests the worker ran meanwhile.
+#
+# Configured by environment variables:
+#   PROFILE_SAMPLE_RATE - Fraction of requests to profile (default 0)
+#   PROFILE_KEY - Value of the profiling header; unset disables the header
+#   PROFILE_MODE - 'cprofile' or 'sample'
+#   PROFILE_SAMPLE_INTERVAL - Seconds between stack samples (default 0.005)
+#   PROFILE_BUFFER_SIZE - Profiles kept per process (default 50)
+
+import cProfile
+import datetime
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+PROFILE_HEADER = 'X-Profile'
+# SQL statements kept per profile; the rest are only counted
+MAX_PROFILE_STATEMENTS = 500
+# Functions listed in the text report of a cProfile profile
+REPORT_FUNCTIONS = 40
+
+class StackSampler(object):
+    """Background thread that records the stacks of registered threads"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, thread_id):
+        """Starts sampling a thread"""
+        with self._lock:
+            self._stacks[thread_id] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='profile-sampler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, thread_id):
+        """Stops sampling a thread, returning its stack counts"""
+        with self._lock:
+            return self._stacks.pop(thread_id, Counter())
+
+    def run(self):
+        """Sampler thread main loop, which ends when no thread is sampled"""
+        while True:
+            with self._lock:
+                if not self._stacks:
+                    self._thread = None
+                    return
+                frames = sys._current_frames() # pylint: disable=W0212
+                for thread_id, stacks in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[folded_stack(frame)] += 1
+            time.sleep(self.interval)
+
+def folded_stack(frame):
+    """Returns a stack as root;...;leaf function names"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class RequestProfile(object):
+    """Profile of one request, with its SQL statements"""
+
+    def __init__(self, profile_id, mode, trigger, sampler=None):
+        self.profile_id = profile_id
+        self.mode = mode
+        self.trigger = trigger
+        self.started = datetime.datetime.utcnow()
+        self.statements = []
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.summary = None
+        self.stats = None
+        self.stacks = None
+        self._sampler = sampler
+        self._thread_id = threading.current_thread().ident
+        self._start = time.time()
+        if mode == 'sample':
+            self._profiler = None
+            sampler.add(self._thread_id)
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def record_sql(self, statement, seconds):
+        """Records one SQL statement run by the request"""
+        self.sql_count += 1
+        self.sql_seconds += seconds
+        if len(self.statements) < MAX_PROFILE_STATEMENTS:
+            self.statements.append((statement, seconds))
+
+    def finish(self, method, path, operation, status):
+        """Stops profiling and fills in the summary of the request"""
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.create_stats()
+            self.stats = self._profiler.stats
+            self._profiler = None
+        else:
+            self.stacks = self._sampler.remove(self._thread_id)
+        self.summary = {
+            'profile_id': self.profile_id,
+            'mode': self.mode,
+            'trigger': self.trigger,
+            'started': self.started.isoformat() + 'Z',
+            'method': method,
+            'path': path,
+            'operation': operation,
+            'status': status,
+            'duration_ms': (time.time() - self._start) * 1000.0,
+            'sql_count': self.sql_count,
+            'sql_ms': self.sql_seconds * 1000.0
+        }
+
+    def details(self):
+        """Returns the summary, the SQL statements and a text report of the profile"""
+        ret = dict(self.summary)
+        ret['sql'] = [{'statement': statement, 'ms': seconds * 1000.0}
+                      for statement, seconds in self.statements]
+        ret['report'] = self.report()
+        return ret
+
+    def report(self):
+        """Returns the top functions by cumulative time, or the folded stacks"""
+        if self.stats is None:
+            return self.folded()
+        out = io.StringIO()
+        stats = pstats.Stats(self, stream=out)
+        stats.sort_stats('cumulative').print_stats(REPORT_FUNCTIONS)
+        return out.getvalue()
+
+    def create_stats(self):
+        """Does nothing; pstats.Stats calls it before reading the stats attribute"""
+        pass
+
+    def pstats_data(self):
+        """Returns the profile in the binary format pstats and snakeviz load, or None"""
+        if self.stats is None:
+            return None
+        return marshal.dumps(self.stats)
+
+    def folded(self):
+        """Returns the sampled stacks as folded stack lines, or None"""
+        if self.stacks is None:
+            return None
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+class RequestProfiler(object):
+    """Decides which requests to profile and keeps their finished profiles"""
+
+    def __init__(self, sample_rate=0.0, key=None, mode='cprofile', sample_interval=0.005,
+                 buffer_size=50):
+        self.sample_rate = sample_rate
+        self.key = key
+        self.mode = mode
+        self.profiles = deque(maxlen=buffer_size)
+        self._sampler = StackSampler(sample_interval)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self, headers):
+        """Returns a RequestProfile if this request should be profiled, otherwise None"""
+        # The key is compared as bytes, as compare_digest refuses strings
+        # that are not ASCII
+        if self.sample_rate and random.random() < self.sample_rate:
+            trigger = 'sample'
+        elif self.key and PROFILE_HEADER in headers and\
+             hmac.compare_digest(headers[PROFILE_HEADER].encode('utf-8'),
+                                 self.key.encode('utf-8')):
+            trigger = 'header'
+        else:
+            return None
+        profile_id = '%d-%d' % (os.getpid(), next(self._ids))
+        try:
+            return RequestProfile(profile_id, self.mode, trigger, self._sampler)
+        except ValueError:
+            # Newer Pythons allow one cProfile profiler at a time per process
+            return None
+
+    def finish(self, profile, method, path, operation, status):
+        """Finishes a request's profile and adds it to the ring buffer"""
+        profile.finish(method, path, operation, status)
+        with self._lock:
+            self.profiles.append(profile)
+
+    def list(self):
+        """Returns the summaries of the stored profiles, newest first"""
+        with self._lock:
+            return [profile.summary for profile in reversed(self.profiles)]
+
+    def get(self, profile_id):
+        """Returns a stored profile by id, or None"""
+        with self._lock:
+            return next((profile for profile in self.profiles
+                         if profile.profile_id == profile_id), None)
+
+    def settings(self):
+        """Returns the current profiling settings"""
+        return {'sample_rate': self.sample_rate, 'mode': self.mode,
+                'header_enabled': bool(self.key), 'buffer_size': self.profiles.maxlen}
+
+PROFILER = RequestProfiler(float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+                           os.environ.get('PROFILE_KEY') or None,
+                           os.environ.get('PROFILE_MODE', 'cprofile'),
+                           float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005)),
+                           int(os.environ.get('PROFILE_BUFFER_SIZE', 50)))
@@ -0,0 +1,185 @@
+"""recaptcha.py - Google ReCaptcha verification client"""
+# User signup confirms the ReCaptcha token from the client with Google. The
+# verifier here keeps a pool of keep-alive connections to Google rather than
+# opening a new TLS connection per signup, bounds every call with connect and
+# read timeouts, and puts a circuit breaker in front of the backend. After
+# RECAPTCHA_FAILURE_THRESHOLD consecutive errors the breaker opens and calls
+# are not attempted until RECAPTCHA_RESET_TIMEOUT seconds have passed, when a
+# single trial call is let through. While the breaker is open (or a call
+# fails) verification either fails closed, raising RecaptchaUnavailable, or
+# fails open and accepts the signup, depending on RECAPTCHA_FAIL_OPEN.
+#
+# The backend is pluggable. The stub backend answers locally without network
+# access, and is the default when running tests (NODE_ENV=test).
+#
+# Configured by environment variables:
+#   RECAPTCHA_BACKEND - 'google' or 'stub'
+#   RECAPTCHA_SECRET - Secret key for the Google siteverify API
+#   RECAPTCHA_CONNECT_TIMEOUT, RECAPTCHA_READ_TIMEOUT - Seconds (default 2 and 5)
+#   RECAPTCHA_POOL_SIZE - Keep-alive connections to Google (default 10)
+#   RECAPTCHA_FAILURE_THRESHOLD - Consecutive errors that open the breaker (default 5)
+#   RECAPTCHA_RESET_TIMEOUT - Seconds the breaker stays open (default 30)
+#   RECAPTCHA_FAIL_OPEN - 1 to accept signups while Google is unavailable (default 0)
+#   RECAPTCHA_STUB_SUCCESS - 0 to make the stub reject every token (default 1)
+#   RECAPTCHA_STUB_LATENCY - Seconds the stub waits before answering (default 0)
+
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from util.metrics import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+# API constants for Google ReCaptcha APIs
+RECAPTCHA_URL = 'https://www.google.com/recaptcha/api/siteverify'
+RECAPTCHA_KEY = '6LcUlxgUAAAAAK5wC6dv6XEcJFvtIbmJsFwyE3Hb'
+
+class RecaptchaUnavailable(Exception):
+    """Raised when a token cannot be verified and the verifier fails closed"""
+    pass
+
+class GoogleRecaptchaBackend(object):
+    """Verifies tokens with the Google siteverify API over pooled connections"""
+
+    def __init__(self, secret, connect_timeout=2.0, read_timeout=5.0, pool_size=10):
+        self.secret = secret
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+
+    def verify(self, token, remote_ip):
+        """Returns True if Google accepts the token, raising on transport errors"""
+        resp = self.session.post(RECAPTCHA_URL, timeout=self.timeout, data={
+            'secret': self.secret,
+            'response': token,
+            'remoteip': remote_ip})
+        resp.raise_for_status()
+        return bool(resp.json().get('success'))
+
+class StubRecaptchaBackend(object):
+    """Answers verification locally, for tests and benchmarks"""
+
+    def __init__(self, success=True, latency=0.0):
+        self.success = success
+        self.latency = latency
+
+    def verify(self, token, remote_ip): # pylint: disable=W0613
+        """Returns the configured answer after the configured latency"""
+        if self.latency:
+            time.sleep(self.latency)
+        return self.success
+
+class CircuitBreaker(object):
+    """Stops calling a failing backend until a reset timeout has passed"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Returns 'closed', 'open' or 'half-open'"""
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Returns True if a call may be made; only one trial call is allowed when half open"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        """Closes the breaker after a successful call"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        """Counts a failed call, opening the breaker at the threshold"""
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+class RecaptchaVerifier(object):
+    """Verifies ReCaptcha tokens through a backend guarded by a circuit breaker"""
+
+    def __init__(self, backend, breaker, fail_open=False):
+        self.backend = backend
+        self.breaker = breaker
+        self.fail_open = fail_open
+        self.latency = Histogram()
+        self.errors = 0
+        self.short_circuits = 0
+
+    def verify(self, token, remote_ip):
+        """Returns True if the token is valid; raises RecaptchaUnavailable when failing closed"""
+        if not self.breaker.allow():
+            self.short_circuits += 1
+            return self._unavailable('circuit breaker is open')
+        start = time.time()
+        try:
+            result = self.backend.verify(token, remote_ip)
+        except Exception as err: # pylint: disable=W0703
+            # Any error, such as a response that is not a JSON object, counts
+            # as a failure, so that a half open breaker's trial always ends
+            if not isinstance(err, (requests.RequestException, ValueError)):
+                LOGGER.exception('Unexpected error verifying a ReCaptcha token')
+            self.latency.observe(time.time() - start)
+            self.errors += 1
+            self.breaker.record_failure()
+            return self._unavailable(err)
+        self.latency.observe(time.time() - start)
+        self.breaker.record_success()
+        return result
+
+    def _unavailable(self, reason):
+        """Accepts the token if failing open, otherwise raises RecaptchaUnavailable"""
+        if self.fail_open:
+            LOGGER.warning('Accepting ReCaptcha token unverified: %s', reason)
+            return True
+        raise RecaptchaUnavailable('ReCaptcha verification unavailable: %s' % reason)
+
+    def stats(self):
+        """Returns a dictionary of the latency histogram, breaker state and error counts"""
+        return {
+            'latency': self.latency.snapshot(),
+            'breaker': self.breaker.state,
+            'errors': self.errors,
+            'short_circuits': self.short_circuits
+        }
+
+def backend_from_environ():
+    """Returns the backend selected by RECAPTCHA_BACKEND"""
+    default = 'stub' if os.environ.get('NODE_ENV') == 'test' else 'google'
+    if os.environ.get('RECAPTCHA_BACKEND', default) == 'stub':
+        return StubRecaptchaBackend(os.environ.get('RECAPTCHA_STUB_SUCCESS', '1') != '0',
+                                    float(os.environ.get('RECAPTCHA_STUB_LATENCY', 0)))
+    return GoogleRecaptchaBackend(os.environ.get('RECAPTCHA_SECRET', RECAPTCHA_KEY),
+                                  float(os.environ.get('RECAPTCHA_CONNECT_TIMEOUT', 2)),
+                                  float(os.environ.get('RECAPTCHA_READ_TIMEOUT', 5)),
+                                  int(os.environ.get('RECAPTCHA_POOL_SIZE', 10)))
+
+RECAPTCHA = RecaptchaVerifier(
+    backend_from_environ(),
+    CircuitBreaker(int(os.environ.get('RECAPTCHA_FAILURE_THRESHOLD', 5)),
+                   float(os.environ.get('RECAPTCHA_RESET_TIMEOUT', 30))),
+    os.environ.get('RECAPTCHA_FAIL_OPEN', '0') == '1')
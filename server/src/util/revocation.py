@@ -0,0 +1,305 @@
+"""revocation.py - Revocation of access tokens before they expire"""
+# Logging out revokes the access token, so that a copy of it taken from the
+# client cannot be used for the rest of its lifetime. Revoked tokens are
+# kept by their jti claim in simplekv filesystem stores in a directory
+# shared by the worker processes. Each process keeps a bloom filter of the
+# revoked jtis in front of the store, so checking a token that has not been
+# revoked, which is nearly every request, needs no I/O. Only tokens the
+# filter reports as (possibly) revoked are looked up in the store.
+#
+# A background thread adds the revocations made by other processes to the
+# filter every REVOCATION_SYNC_INTERVAL seconds, so a token revoked by one
+# worker is refused by the others within that interval (and by the revoking
+# worker at once). Besides the store of all revoked tokens, used for
+# lookups, each revocation is put in a store of the LOG_SECONDS in which it
+# was made, so a sync lists only the stores of the last two such periods
+# rather than every revoked token. Once every token of an older period has
+# expired, its tokens are deleted. A bloom filter cannot forget entries, so
+# once it holds more expired tokens than live ones (and more than a tenth of
+# its capacity), or more live tokens than it was sized for, it is rebuilt
+# from the live tokens in the store.
+#
+# install() adds the check to the decode function flask_jwt_extended's view
+# decorators use, so it runs on every authenticated request, including those
+# whose token claims come from the verified JWT cache (see util/jwt_cache.py).
+# flask_jwt_extended's own blacklist is not used, as it looks up every token
+# in its store on every request.
+#
+# Configured by environment variables:
+#   REVOCATION_DIR - Directory shared by the worker processes for the store
+#                    (default olsnet-revocations in the temporary directory)
+#   REVOCATION_SYNC_INTERVAL - Seconds between syncs (default 1)
+#   REVOCATION_CAPACITY - Revoked tokens the filter is sized for (default 100000)
+#   REVOCATION_ERROR_RATE - Filter false positive rate at capacity (default 0.001)
+# The directory is shared by the worker processes on one host, so each host
+# serving the API keeps its own revocations.
+
+import hashlib
+import heapq
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from flask_jwt_extended import view_decorators
+from flask_jwt_extended.exceptions import RevokedTokenError
+from simplekv.fs import FilesystemStore
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds of revocations in each period store
+LOG_SECONDS = 60
+
+class BloomFilter(object):
+    """Fixed size set of strings that can give false positives but not false negatives"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        """Returns the bit positions of an item, from two hashes combined"""
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + number * second) % self.size for number in range(self.hashes)]
+
+    def add(self, item):
+        """Adds an item, returning False if it (probably) was already present"""
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+def token_name(jti, exp):
+    """Returns the name of a revoked token in a store"""
+    return '%d.%s' % (exp, jti)
+
+def parse_token_name(name):
+    """Returns (jti, exp) of a revoked token's name in a store"""
+    exp, jti = name.split('.', 1)
+    return jti, int(exp)
+
+class FilesystemRevocationStore(object):
+    """Revoked tokens in simplekv filesystem stores shared by the processes on a host"""
+
+    def __init__(self, directory):
+        os.makedirs(os.path.join(directory, 'tokens'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'periods'), exist_ok=True)
+        self.tokens = FilesystemStore(os.path.join(directory, 'tokens'))
+        self.periods = os.path.join(directory, 'periods')
+        # Keys already read from the periods still being written to, and the
+        # latest expiry in each period read
+        self._seen = {}
+        self._latest = {}
+
+    def _period(self, name):
+        """Returns the store of the revocations made in a period"""
+        return FilesystemStore(os.path.join(self.periods, name))
+
+    def add(self, jti, exp, now):
+        """Stores a revoked token"""
+        key = token_name(jti, exp)
+        # The token is stored first, so a process that reads the period's
+        # entry can look it up
+        self.tokens.put(key, b'')
+        name = str(int(now // LOG_SECONDS))
+        os.makedirs(os.path.join(self.periods, name), exist_ok=True)
+        self._period(name).put(key, b'')
+
+    def contains(self, jti, exp):
+        """Returns True if a token has been revoked"""
+        return token_name(jti, exp) in self.tokens
+
+    def changes(self, now):
+        """Returns (jti, exp) of the tokens revoked since the last call, all of them at first"""
+        # The previous period stays open too, for revocations made as it ended
+        first_open = int(now // LOG_SECONDS) - 1
+        names = os.listdir(self.periods)
+        for name in set(self._latest) - set(names):
+            del self._latest[name]
+            self._seen.pop(name, None)
+        revoked = []
+        for name in names:
+            # A closed period that has been read has nothing new
+            if name in self._latest and name not in self._seen:
+                continue
+            try:
+                keys = set(self._period(name).keys())
+            except FileNotFoundError:
+                continue
+            latest = self._latest.get(name, 0)
+            for key in keys - self._seen.get(name, set()):
+                jti, exp = parse_token_name(key)
+                revoked.append((jti, exp))
+                latest = max(latest, exp)
+            self._latest[name] = latest
+            if int(name) >= first_open:
+                self._seen[name] = keys
+            else:
+                self._seen.pop(name, None)
+        return revoked
+
+    def expire(self, now):
+        """Deletes the tokens of the closed periods whose tokens have all expired"""
+        for name, latest in list(self._latest.items()):
+            if name in self._seen or latest > now:
+                continue
+            # Another process may be deleting the same period
+            try:
+                period = self._period(name)
+                for key in period.keys():
+                    self.tokens.delete(key)
+                    period.delete(key)
+                os.rmdir(os.path.join(self.periods, name))
+            except FileNotFoundError:
+                pass
+            del self._latest[name]
+
+    def live(self, now):
+        """Returns (jti, exp) of every unexpired revoked token"""
+        tokens = [parse_token_name(key) for key in self.tokens.keys()]
+        return [(jti, exp) for jti, exp in tokens if exp > now]
+
+class RevocationList(object):
+    """Revoked tokens, in a shared store with a bloom filter in front"""
+
+    def __init__(self, store, sync_interval=1.0, capacity=100000, error_rate=0.001):
+        self.store = store
+        self.sync_interval = sync_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.checks = 0
+        self.lookups = 0
+        self.false_positives = 0
+        self.revoked = 0
+        self._filter = BloomFilter(capacity, error_rate)
+        # Expiry times of the tokens in the filter, soonest first
+        self._expiries = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def revoke(self, claims):
+        """Revokes a token until it expires, given its claims"""
+        now = time.time()
+        if claims['exp'] <= now:
+            return
+        self.store.add(claims['jti'], claims['exp'], now)
+        # Holding the lock keeps a rebuild from replacing the filter with one
+        # made before this token was stored
+        with self._lock:
+            self._add(claims['jti'], claims['exp'])
+            self.revoked += 1
+
+    def _add(self, jti, exp):
+        """Adds a token to the filter"""
+        if self._filter.add(jti):
+            heapq.heappush(self._expiries, exp)
+
+    def is_revoked(self, claims):
+        """Returns True if a token, given its claims, has been revoked"""
+        self.checks += 1
+        jti = claims.get('jti')
+        if jti is None or jti not in self._filter:
+            return False
+        self.lookups += 1
+        # A store error fails the request rather than let the token through
+        if self.store.contains(jti, claims['exp']):
+            return True
+        self.false_positives += 1
+        return False
+
+    def start(self):
+        """Loads the revoked tokens and starts syncing them in the background"""
+        if self._thread and self._thread.is_alive():
+            return
+        self.sync()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name='revocation-sync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops syncing"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(self.sync_interval)
+            self._thread = None
+
+    def run(self):
+        """Sync thread main loop"""
+        while not self._stopping.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Adds revocations made by other processes to the filter, rebuilding it if needed"""
+        try:
+            now = time.time()
+            revoked = self.store.changes(now)
+            self.store.expire(now)
+            with self._lock:
+                for jti, exp in revoked:
+                    if exp > now:
+                        self._add(jti, exp)
+                while self._expiries and self._expiries[0] <= now:
+                    heapq.heappop(self._expiries)
+                live = len(self._expiries)
+                if self._filter.count > max(2 * live, self.capacity // 10) or\
+                   live > self.capacity:
+                    self._rebuild(self.store.live(now))
+        except Exception: # pylint: disable=W0703
+            # The filter keeps what it has, and the next sync tries again
+            LOGGER.exception('Unable to sync revoked tokens')
+
+    def _rebuild(self, tokens):
+        """Replaces the filter with one of the given (jti, exp) tokens"""
+        self._filter = BloomFilter(max(self.capacity, 2 * len(tokens)), self.error_rate)
+        self._expiries = []
+        for jti, exp in tokens:
+            self._add(jti, exp)
+
+    def stats(self):
+        """Returns a dictionary with the revocation check counts and filter size"""
+        return {'checks': self.checks, 'lookups': self.lookups,
+                'false_positives': self.false_positives, 'revoked': self.revoked,
+                'live': len(self._expiries), 'filter_entries': self._filter.count}
+
+def store_from_environ():
+    """Returns the store in REVOCATION_DIR, shared by the worker processes"""
+    return FilesystemRevocationStore(os.environ.get('REVOCATION_DIR') or
+                                     os.path.join(tempfile.gettempdir(), 'olsnet-revocations'))
+
+REVOCATIONS = RevocationList(store_from_environ(),
+                             float(os.environ.get('REVOCATION_SYNC_INTERVAL', 1)),
+                             int(os.environ.get('REVOCATION_CAPACITY', 100000)),
+                             float(os.environ.get('REVOCATION_ERROR_RATE', 0.001)))
+
+def install():
+    """Makes flask_jwt_extended's view decorators refuse revoked tokens"""
+    decode = view_decorators.decode_jwt
+    # Every app created installs the check, which must not wrap itself
+    if getattr(decode, 'checks_revocation', False):
+        return
+
+    def decode_unrevoked_jwt(*args, **kwargs):
+        """Returns the claims of a JWT, raising RevokedTokenError if it was revoked"""
+        claims = decode(*args, **kwargs)
+        if REVOCATIONS.is_revoked(claims):
+            raise RevokedTokenError('Token has been revoked')
+        return claims
+    decode_unrevoked_jwt.checks_revocation = True
+    view_decorators.decode_jwt = decode_unrevoked_jwt
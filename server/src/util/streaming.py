@@ -0,0 +1,96 @@
+"""streaming.py - Helpers for streaming large API responses"""
+# The intent of this module is to let list style APIs write their results as
+# they are read from the database, rather than building the whole result in
+# memory first. Because Flask runs after_request (which closes the request
+# database session) before a streamed body is consumed, the generators here
+# own the session for the rest of the response and close it when done.
+
+import csv
+import io
+import zlib
+from flask import Response, g, stream_with_context
+from util.fast_json import dumps
+
+# Number of serialized rows to group into each chunk written to the client
+STREAM_CHUNK_ROWS = 100
+# zlib window bits that make compressobj write the gzip file format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def stream_json_array(rows, dump):
+    """Returns a streamed response that writes rows as a JSON array, using dump for each row"""
+    def generate():
+        """Generator that yields the JSON array in chunks"""
+        try:
+            yield b'['
+            separator = b''
+            chunk = []
+            for row in rows:
+                chunk.append(separator + dumps(dump(row)))
+                separator = b','
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield b''.join(chunk)
+                    chunk = []
+            chunk.append(b']')
+            yield b''.join(chunk)
+        finally:
+            g.db_session.close()
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def stream_lines(rows, encode, mimetype, header=b'', compress=False, filename=None):
+    """Returns a streamed response of rows encoded as lines, optionally gzip compressed"""
+    def generate():
+        """Generator that yields the encoded rows in chunks"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS) if compress else None
+        try:
+            chunk = [header]
+            for row in rows:
+                chunk.append(encode(row))
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield _output(compressor, b''.join(chunk))
+                    chunk = []
+            data = _output(compressor, b''.join(chunk))
+            if compressor:
+                data += compressor.flush()
+            yield data
+        finally:
+            g.db_session.close()
+    headers = {}
+    if filename:
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return Response(stream_with_context(generate()), headers=headers,
+                    mimetype='application/gzip' if compress else mimetype)
+
+def _output(compressor, data):
+    """Returns data, or data compressed and flushed so the client receives it now"""
+    if compressor is None:
+        return data
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def ndjson_encoder(dump):
+    """Returns a row encoder for newline delimited JSON, using dump for each row"""
+    return lambda row: dumps(dump(row)) + b'\n'
+
+def csv_encoder(fields, dump):
+    """Returns a row encoder for CSV with the given fields, writing nested values as JSON"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def encode(row):
+        """Returns one row as a CSV line"""
+        values = dump(row)
+        writer.writerow([_csv_value(values[field]) for field in fields])
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line.encode('utf-8')
+    return encode
+
+def csv_header(fields):
+    """Returns the CSV header line for the given fields"""
+    return (','.join(fields) + '\r\n').encode('utf-8')
+
+def _csv_value(value):
+    """Returns a CSV cell value, with dictionaries and lists as inline JSON"""
+    if isinstance(value, (dict, list)):
+        return dumps(value).decode('utf-8')
+    return value
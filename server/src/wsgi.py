@@ -0,0 +1,8 @@
+"""wsgi.py - WSGI entry point for serving the API with gunicorn"""
+# Each gunicorn worker imports this module after it has been forked, so each
+# worker builds its own app, database engine and connection pool:
+#   gunicorn -c /app/gunicorn_conf.py wsgi:application
+from server import create_app
+
+APP = create_app()
+application = APP.app # pylint: disable=C0103
@@ -26,7 +26,7 @@ def get_response_with_jwt(test_session, method, url, payload=None, use_refresh_c
     # If test_session is defined, then use it, otherwise use requests
     req = test_session['session'] if test_session else requests
     args = {}
-    if method == 'PUT' or method == 'POST':
+    if method == 'PUT' or method == 'POST' or method == 'PATCH':
         args['json'] = payload
     if test_session and (test_session['csrf_token'] or test_session['csrf_refresh_token']):
         if use_refresh_csrf:
@@ -41,6 +41,8 @@ def get_response_with_jwt(test_session, method, url, payload=None, use_refresh_c
         resp = req.put(BASE_URL + url, **args)
     elif method == 'POST':
         resp = req.post(BASE_URL + url, **args)
+    elif method == 'PATCH':
+        resp = req.patch(BASE_URL + url, **args)
     elif method == 'DELETE':
         resp = req.delete(BASE_URL + url, **args)
     if resp and test_session and 'csrf_access_token' in resp.cookies:
@@ -6,6 +6,7 @@ import logging
 from sqlalchemy import create_engine, exc
 from sqlalchemy.orm import sessionmaker
 from src.dm.User import User
+from src.dm.Outbox import OutboxMessage
 from TestUtil import get_response_with_jwt, get_new_session,\
                      log_response_error
 
@@ -86,6 +87,18 @@ def test_reset_start_valid():
     assert 'refresh_token_cookie' in TEST_SESSION['session'].cookies
     assert 'csrf_refresh_token' in TEST_SESSION['session'].cookies
 
+def test_reset_start_queues_email():
+    """--> Test that starting a reset queues an email with the reset code"""
+    session = DBSESSION()
+    user = session.query(User).filter(User.email == 'reset@wittle.net').one_or_none()
+    assert user
+    message = session.query(OutboxMessage)\
+                     .filter(OutboxMessage.recipient == 'reset@wittle.net')\
+                     .order_by(OutboxMessage.message_id.desc()).first()
+    assert message
+    assert user.reset_code in message.body_text
+    session.close()
+
 def test_rest_start_fails_existing_code():
     """--> Test getting a second reset code when existing one has not expired fails"""
     resp = get_response_with_jwt(TEST_SESSION, 'POST', '/pw_reset', {'email': 'reset@wittle.net'})
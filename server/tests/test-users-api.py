@@ -5,8 +5,13 @@
 # tests.
 """test-users-api.py - Tests of users APIs"""
 import logging
+import csv
+import gzip
+import json as json_module
+import threading
+import requests
 from TestUtil import get_response_with_jwt, get_new_session,\
-                     log_response_error
+                     log_response_error, BASE_URL
 
 # Set up logger
 LOGGER = logging.getLogger()
@@ -92,6 +97,23 @@ def test_rehydrate():
     assert json['username'] == 'testing'
     assert 'preferences' in json
 
+def test_token_refresh_skipped():
+    """--> Test a fresh access token is not re-issued on every response"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/login')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    assert 'csrf_access_token' not in resp.cookies
+    assert 'access_token_cookie' not in resp.cookies
+
+def test_cached_token_checks_csrf():
+    """--> Test a token verified by an earlier request still needs its CSRF header"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/login')
+    assert resp.status_code == 200
+    resp = TEST_SESSION['session'].get(BASE_URL + '/login')
+    assert resp.status_code == 401
+    resp = TEST_SESSION['session'].get(BASE_URL + '/login', headers={'X-CSRF-TOKEN': 'wrong'})
+    assert resp.status_code == 401
+
 def test_update_user_success():
     """--> Update a user from a different user with Admin role"""
     update_data = {
@@ -108,6 +130,70 @@ def test_update_user_success():
     assert resp2.status_code == 200
     assert resp2.json()['phone'] == '9197776666'
 
+def test_user_etag():
+    """--> Test a user unchanged since its ETag is answered with a 304"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users/' + added_id)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    headers = {'X-CSRF-TOKEN': TEST_SESSION['csrf_token'], 'If-None-Match': etag}
+    resp = TEST_SESSION['session'].get(BASE_URL + '/users/' + added_id, headers=headers)
+    assert resp.status_code == 304
+    assert not resp.content
+    update_data = {
+        'username': 'talw',
+        'password': 'testing0',
+        'email': 'talw@wittle.net',
+        'phone': '9197776667'
+    }
+    resp = get_response_with_jwt(TEST_SESSION, 'PUT', '/users/' + added_id, update_data)
+    assert resp.status_code == 200
+    resp = TEST_SESSION['session'].get(BASE_URL + '/users/' + added_id, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+    assert resp.json()['phone'] == '9197776667'
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/login')
+    headers['If-None-Match'] = resp.headers['ETag']
+    resp = TEST_SESSION['session'].get(BASE_URL + '/login', headers=headers)
+    assert resp.status_code == 304
+
+def test_concurrent_updates():
+    """--> Test updates of the same user racing each other succeed or get a 409, never a 500"""
+    statuses = {}
+    def update(phone):
+        """Updates the added user's phone, recording the response status"""
+        update_data = {
+            'username': 'talw',
+            'password': 'testing0',
+            'email': 'talw@wittle.net',
+            'phone': phone
+        }
+        resp = get_response_with_jwt(TEST_SESSION, 'PUT', '/users/' + added_id, update_data)
+        log_response_error(resp)
+        statuses[phone] = resp.status_code
+    threads = [threading.Thread(target=update, args=('91977766%02d' % number,))
+               for number in range(70, 76)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(statuses.values()) <= {200, 409}
+    assert 200 in statuses.values()
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users/' + added_id)
+    assert statuses[resp.json()['phone']] == 200
+
+def test_user_batch_get():
+    """--> Test fetching several users by ID in one request"""
+    unknown_id = '00000000-0000-0000-0000-000000000000'
+    batch = {'ids': [added_id, unknown_id, testing_id, 'not-a-user-id']}
+    resp = get_response_with_jwt(TEST_SESSION, 'POST', '/users/batch_get', batch)
+    log_response_error(resp)
+    assert resp.status_code == 200
+    json = resp.json()
+    assert [user['username'] for user in json['users']] == ['talw', 'testing']
+    assert json['users'][0]['user_id'] == added_id
+    assert 'password_hash' not in json['users'][0]
+    assert json['missing'] == [unknown_id, 'not-a-user-id']
+
 # Note that these tests are after the rest because they will
 # clear the global CSRF token used by TEST_SESSION
 def test_self_update():
@@ -171,6 +257,43 @@ def test_update_invalid_password():
     resp = get_response_with_jwt(new_session, 'PUT', '/users/' + testing_id, update_data)
     assert resp.status_code == 401
 
+def test_user_patch():
+    """--> Test merge patching a user's preferences and fields"""
+    new_session = get_new_session()
+    login_data = {'username': 'talw', 'password': 'testing3'}
+    resp = get_response_with_jwt(new_session, 'POST', '/login', login_data)
+    assert resp.status_code == 200
+    # Preferences alone do not need the password
+    patch = {'preferences': {'color': 'blue', 'size': 'large'}}
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id, patch)
+    log_response_error(resp)
+    assert resp.status_code == 200
+    resp = get_response_with_jwt(new_session, 'GET', '/users/' + added_id)
+    assert resp.json()['preferences'] == {'color': 'blue', 'size': 'large'}
+    patch = {'preferences': {'size': None, 'layout': {'columns': 2}}}
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id, patch)
+    assert resp.status_code == 200
+    resp = get_response_with_jwt(new_session, 'GET', '/users/' + added_id)
+    assert resp.json()['preferences'] == {'color': 'blue', 'layout': {'columns': 2}}
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id,
+                                 {'phone': '9195551234'})
+    assert resp.status_code == 401
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id,
+                                 {'phone': '9195551234', 'password': 'testing3'})
+    assert resp.status_code == 200
+    resp = get_response_with_jwt(new_session, 'GET', '/users/' + added_id)
+    assert resp.json()['phone'] == '9195551234'
+    assert resp.json()['first_name'] == 'Tal'
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + testing_id,
+                                 {'preferences': {'color': 'green'}})
+    assert resp.status_code == 401
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id,
+                                 {'roles': 'Admin', 'password': 'testing3'})
+    assert resp.status_code == 401
+    patch = {'preferences': {'color': 'red', 'layout': None}}
+    resp = get_response_with_jwt(new_session, 'PATCH', '/users/' + added_id, patch)
+    assert resp.status_code == 200
+
 def test_user_list():
     """--> Test list users"""
     resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?search_text=')
@@ -182,6 +305,7 @@ def test_user_list():
     assert len(json) > 1
     assert json[0]['username'] == 'talw'
     assert json[1]['username'] == 'testing'
+    assert 'X-Next-Cursor' not in resp.headers
 
 def test_user_list_with_query():
     """--> Test list users"""
@@ -194,6 +318,134 @@ def test_user_list_with_query():
     assert len(json) == 1
     assert json[0]['username'] == 'talw'
 
+def test_user_list_with_short_query():
+    """--> Test list users with search text shorter than a trigram"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?search_text=lw')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    json = resp.json()
+    assert len(json) == 1
+    assert json[0]['username'] == 'talw'
+
+def test_user_list_paged():
+    """--> Test list users one page at a time"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?search_text=&limit=1')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    json = resp.json()
+    assert len(json) == 1
+    assert json[0]['username'] == 'talw'
+    assert 'X-Next-Cursor' in resp.headers
+    resp2 = get_response_with_jwt(TEST_SESSION, 'GET',
+                                  '/users?limit=1&after=' + resp.headers['X-Next-Cursor'])
+    log_response_error(resp2)
+    assert resp2.status_code == 200
+    assert resp2.json()[0]['username'] == 'testing'
+
+def test_user_list_bad_cursor():
+    """--> Test list users fails with an invalid cursor"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?after=not*a*cursor')
+    assert resp.status_code == 400
+
+def test_user_list_stream():
+    """--> Test list users with a streamed response"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?search_text=&stream=true')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    json = resp.json()
+    assert len(json) > 1
+    assert json[0]['username'] == 'talw'
+    assert json[1]['username'] == 'testing'
+
+def test_user_bulk_import():
+    """--> Test bulk import of users from newline delimited JSON"""
+    new_user = {
+        'username': 'zbulk01',
+        'password': 'testing1',
+        'email': 'zbulk01@wittle.net',
+        'phone': '9195550101',
+        'first_name': 'Bulk',
+        'last_name': 'Import'
+    }
+    same_email = dict(new_user, username='zbulk02', phone='9195550102')
+    existing_user = dict(new_user, username='talw', email='zbulk03@wittle.net', phone='9195550103')
+    lines = [json_module.dumps(new_user), json_module.dumps(same_email), '',
+             json_module.dumps(existing_user), '{"username": "zbulk04"', '{"username": "zbulk05"}']
+    resp = TEST_SESSION['session'].post(BASE_URL + '/users/bulk?batch_size=2',
+                                        data='\n'.join(lines) + '\n',
+                                        headers={'Content-Type': 'application/x-ndjson',
+                                                 'X-CSRF-TOKEN': TEST_SESSION['csrf_token']})
+    log_response_error(resp)
+    assert resp.status_code == 200
+    # A response that refreshes the access token also changes the CSRF token
+    if 'csrf_access_token' in resp.cookies:
+        TEST_SESSION['csrf_token'] = resp.cookies['csrf_access_token']
+    results = [json_module.loads(line) for line in resp.text.splitlines()]
+    assert [result.get('status') for result in results[:-1]] ==\
+           ['created', 'duplicate', 'duplicate', 'invalid', 'invalid']
+    assert [result.get('line') for result in results[:-1]] == [1, 2, 4, 5, 6]
+    assert results[1]['field'] == 'email'
+    assert results[2]['field'] == 'username'
+    assert results[-1]['summary'] == {'created': 1, 'duplicate': 2, 'invalid': 2}
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users?search_text=zbulk')
+    assert [user['username'] for user in resp.json()] == ['zbulk01']
+
+def test_user_bulk_import_requires_admin():
+    """--> Test bulk import is refused for users without the Admin role"""
+    new_session = get_new_session()
+    login_data = {'username': 'zbulk01', 'password': 'testing1'}
+    resp = get_response_with_jwt(new_session, 'POST', '/login', login_data)
+    assert resp.status_code == 200
+    resp = new_session['session'].post(BASE_URL + '/users/bulk', data='{}\n',
+                                       headers={'Content-Type': 'application/x-ndjson',
+                                                'X-CSRF-TOKEN': new_session['csrf_token']})
+    assert resp.status_code == 401
+
+def test_request_profiles():
+    """--> Test sampling requests into profiles and downloading them"""
+    resp = get_response_with_jwt(TEST_SESSION, 'PUT', '/profiles', {'sample_rate': 1})
+    log_response_error(resp)
+    assert resp.status_code == 200
+    assert resp.json()['sample_rate'] == 1
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/login')
+    profile_id = resp.headers['X-Profile-Id']
+    resp = get_response_with_jwt(TEST_SESSION, 'PUT', '/profiles', {'sample_rate': 0})
+    assert resp.status_code == 200
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/profiles')
+    log_response_error(resp)
+    assert profile_id in [profile['profile_id'] for profile in resp.json()['profiles']]
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/profiles/' + profile_id)
+    log_response_error(resp)
+    assert resp.status_code == 200
+    json = resp.json()
+    assert json['operation'] == 'api_login_search'
+    assert json['status'] == 200
+    assert 'cumulative' in json['report']
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/profiles/' + profile_id + '?format=pstats')
+    assert resp.status_code == 200
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/profiles/0-0')
+    assert resp.status_code == 404
+
+def test_user_export():
+    """--> Test exporting users as newline delimited JSON"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users/export')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    users = [json_module.loads(line) for line in resp.text.splitlines()]
+    assert [user['username'] for user in users][:2] == ['talw', 'testing']
+    assert users[0]['preferences'] == {'color': 'red'}
+    assert 'password_hash' not in users[0]
+
+def test_user_export_csv_gzip():
+    """--> Test exporting users as gzip compressed CSV"""
+    resp = get_response_with_jwt(TEST_SESSION, 'GET', '/users/export?format=csv&gzip=true')
+    log_response_error(resp)
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'application/gzip'
+    rows = list(csv.DictReader(gzip.decompress(resp.content).decode('utf-8').splitlines()))
+    assert rows[0]['username'] == 'talw'
+    assert json_module.loads(rows[0]['preferences']) == {'color': 'red'}
+
 def test_shutdown_bad_key():
     """--> Test shutdown with bad key for code coverage"""
     resp = get_response_with_jwt(None, 'POST', '/shutdown', {'key': 'Junk'})
@@ -243,6 +495,8 @@ def test_delete_user():
 
 def test_logout():
     """--> Test logging out of session"""
+    # Keep copies of the cookies to check the access token is revoked
+    cookies = TEST_SESSION['session'].cookies.copy()
     resp = get_response_with_jwt(TEST_SESSION, 'POST', '/logout', {})
     log_response_error(resp)
     LOGGER.debug('TEST_SESSION.cookies = ' + str(TEST_SESSION['session'].cookies))
@@ -250,3 +504,6 @@ def test_logout():
     assert 'csrf_access_token' not in TEST_SESSION['session'].cookies
     assert 'access_token_cookie' not in TEST_SESSION['session'].cookies
     assert 'refresh_token_cookie' not in TEST_SESSION['session'].cookies
+    resp = requests.get(BASE_URL + '/login', cookies=cookies,
+                        headers={'X-CSRF-TOKEN': cookies['csrf_access_token']})
+    assert resp.status_code == 401